@@ -1,48 +1,70 @@
+import os
 import datetime
 import pandas as pd
 import numpy as np
-from MutualFundScore.common import *
 
-from tqdm import tqdm
-import statsmodels.api as sm
+from dataFetcher import ConnectionPool, as_pool, fetch_daily_bars
+from symbolCodec import decode_bytes
+from factorLoader import load_all_factors
+from stageMetrics import timed, flush
 
-def regress(fundid, df, normalize = False,printResult = False):
+@timed()
+def regress(fundid, df, normalize = False,printResult = False, factorNames = None):
     '''
     @fundid:"0000001.SZ"
     @df: pd.DataFrame(), columns = ["Rm","Rm2","HML","HML2","SMB","SMB2","return]
     @normalize: bool,
-    @prinResult: bool,
+    @prinResult: bool, print the summary of statsmodels, which is only imported for it
+    @factorNames: list, default ["Rm","Rm2","HML","HML2","SMB","SMB2"], see factorRegistry.MODELS for others
     '''
-    df.dropna(inplace =True)
-    x = df[["Rm","Rm2","HML","HML2","SMB","SMB2"]]
-    y = df[["return"]]
+    if factorNames is None:
+        factorNames = ["Rm", "Rm2", "HML", "HML2", "SMB", "SMB2"]
+    factorNames = list(factorNames)
+    values = df.to_numpy()
+    missing = pd.isna(values).any(axis=1)
+    if missing.any():
+        df.dropna(inplace =True)
+        values = values[~missing]
 
-    #
-    factorNames = list(x.columns)
+    if not printResult:
+        # the OLS of regress_batch on the arrays of the fund, without loading statsmodels or indexing the frame
+        columns = factorNames + ["return"]
+        positions = df.columns.get_indexer(columns)
+        if (positions < 0).any():
+            raise KeyError("{} not in the columns".format([c for c, i in zip(columns, positions) if i < 0]))
+        data = values[:, positions].astype(float)
+        x = data[:, :-1]
+        if normalize:
+            x = (x - x.mean(axis=0)) / x.std(axis=0)
+        names = ["const"] + factorNames
+        params, tvalues, pvalues, nobs = _regress_arrays(x, data[:, -1:])
+        row = np.concatenate([params[0], tvalues[0], pvalues[0]]).tolist()
+        return pd.DataFrame([row + [fundid]], columns=names + [n + "_t" for n in names] + [n + "_p" for n in names]
+                            + ["fundid"])
+
+    x = df[factorNames]
+    y = df[["return"]]
 
     if normalize:
-        x = (x - np.mean(x)) / np.std(x)
+        x = (x - x.mean()) / x.std(ddof=0)
 
     #
+    import statsmodels.api as sm
     x = sm.add_constant(x)
 
     # GLS
     model = sm.GLS(y, x).fit()
 
     #
-    if printResult:
-        print(model.summary2())
+    print(model.summary2())
 
     #
 
     params = model.params
-    tvalues =model.tvalues
-    tvalues.rename(lambda x: x + str("_t"), axis='columns',inplace =True)
-    pvalues = model.pvalues
-    pvalues.rename(lambda x: x + str("_p"), axis='columns',inplace =True)
+    tvalues = model.tvalues.add_suffix("_t")
+    pvalues = model.pvalues.add_suffix("_p")
 
-    res = params.append(tvalues)
-    res = res.append(pvalues)
+    res = pd.concat([params, tvalues, pvalues])
     res["fundid"] = fundid
     res = pd.DataFrame(res)
     res = res.transpose()
@@ -50,98 +72,251 @@ def regress(fundid, df, normalize = False,printResult = False):
     return res
 
 
+@timed()
+def regress_batch(returns, factors, factorNames = None, normalize = False):
+    '''
+    regress every fund at once, the numbers are the same as calling regress() fund by fund
+    @returns: pd.DataFrame(), index = date, columns = fund ids, NaN where the fund has no return
+    @factors: pd.DataFrame(), index = date, columns include factorNames
+    @factorNames: list, default ["Rm","Rm2","HML","HML2","SMB","SMB2"]
+    @normalize: bool, standardize the factors on the sample of each fund
+    :return: pd.DataFrame(), index = fundid, columns = const, factors, "_t" and "_p" of each, "nobs"
+    '''
+    if factorNames is None:
+        factorNames = ["Rm", "Rm2", "HML", "HML2", "SMB", "SMB2"]
+    names = ["const"] + list(factorNames)
+    k = len(names)
 
-def regression_from_calculated_factors(database):
+    dates = returns.index.intersection(factors.index)
+    x = factors.loc[dates, factorNames].to_numpy(dtype=float)
+    y = returns.loc[dates].to_numpy(dtype=float)
+    params, tvalues, pvalues, nobs = _regress_arrays(x, y, normalize)
 
-    startdate = datetime.datetime(2016, 1, 1)
-    enddate = datetime.datetime(2020, 11, 1)
+    res = pd.DataFrame(np.hstack([params, tvalues, pvalues, nobs[:, None]]), index=returns.columns,
+                       columns=names + [n + "_t" for n in names] + [n + "_p" for n in names] + ["nobs"])
+    res.index.name = "fundid"
+    return res[nobs > k]
 
-    #
-    # get_regression_data(database,startdate,enddate,"000002.SZ")
-    market_return = database.Get_Daily_Bar("000001.SH", instrument_type="Index", datetime1=startdate, datetime2=enddate)
-    market_return = pd.DataFrame(market_return)
-    market_return["Rm"] = (market_return["close"] - market_return["close"].shift(periods=1)) / market_return["close"].shift(periods=1)
-    market_return["Rm2"] = market_return["Rm"] * market_return["Rm"]
-    market_return = market_return[["date", "Rm", "Rm2"]]
-    market_return.set_index("date", inplace=True)
-
-    SMB_HML = pd.read_csv("factors.csv")
-    SMB_HML['date'] = SMB_HML['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y/%m/%d"))
-    SMB_HML.set_index("date", inplace=True)
-    SMB_HML = SMB_HML[["SMB", "HML"]]
-    SMB_HML["SMB2"] = SMB_HML["SMB"] * SMB_HML["SMB"]
-    SMB_HML["HML2"] = SMB_HML["HML"] * SMB_HML["HML"]
-    all_factors = market_return.join([SMB_HML], how="inner")
-    # all_factors.to_csv("all_factors.csv")
-    fundlist = database.Get_Instruments_DataFrame(instrument_type="mutualfund")  # ,filter={"invest_type1" :'股票型基金'})
-    fundlist = fundlist[["symbol"]]
-    fundlist["symbol"] = fundlist["symbol"].apply(lambda x: x.decode("utf-8"))
-    funds_list = list(fundlist["symbol"])
-    res = pd.DataFrame()
-    for fundID in tqdm(funds_list):
+
+def _regress_arrays(x, y, normalize = False):
+    '''
+    OLS with a constant of every column of y on x, the rows with NaN in x or in the column are left out
+    @x: np.array, dates x factors
+    @y: np.array, dates x funds
+    :return: params, tvalues, pvalues (funds x (1 + factors)) and nobs (funds)
+    '''
+    from scipy import stats
+
+    x = np.column_stack([np.ones(len(x)), x])
+    k = x.shape[1]
+
+    # a fund uses the dates where both its return and all the factors exist, as df.dropna() in regress
+    mask = ~np.isnan(y) & ~np.isnan(x).any(axis=1)[:, None]
+    x = np.where(np.isnan(x), 0.0, x)
+    y = np.where(mask, y, 0.0)
+    w = mask.astype(float)
+    nobs = w.sum(axis=0)
+
+    # normal equations of every fund with the masked design matrix
+    xx = (x[:, :, None] * x[:, None, :]).reshape(len(x), k * k)
+    XtX = (w.T @ xx).reshape(-1, k, k)
+    Xty = y.T @ x
+
+    if normalize:
+        # Z = X A, so Z'Z = A'X'XA and Z'y = A'X'y
+        mean = XtX[:, 0, 1:] / nobs[:, None]
+        std = np.sqrt(np.diagonal(XtX, axis1=1, axis2=2)[:, 1:] / nobs[:, None] - mean * mean)
+        A = np.zeros_like(XtX)
+        A[:, 0, 0] = 1.0
+        A[:, 0, 1:] = -mean / std
+        A[:, np.arange(1, k), np.arange(1, k)] = 1.0 / std
+    else:
+        A = np.broadcast_to(np.eye(k), XtX.shape)
+    At = np.transpose(A, (0, 2, 1))
+    ZtZinv = np.linalg.pinv(At @ XtX @ A)
+    params = (ZtZinv @ (At @ Xty[:, :, None]))[:, :, 0]
+
+    # residuals with the coefficients of the original design
+    xparams = (A @ params[:, :, None])[:, :, 0]
+    resid = (y - x @ xparams.T) * w
+    dfresid = nobs - k
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma2 = (resid * resid).sum(axis=0) / dfresid
+        bse = np.sqrt(sigma2[:, None] * np.diagonal(ZtZinv, axis1=1, axis2=2))
+        tvalues = params / bse
+    pvalues = 2 * stats.t.sf(np.abs(tvalues), dfresid[:, None])
+
+    return params, tvalues, pvalues, nobs
+
+
+@timed()
+def rolling_regress(returns, factors, window = 60, factorNames = None, expanding = False, min_nobs = None, chunksize = 256):
+    '''
+    the regression of regress() on a rolling (or expanding) window of trading days for every fund
+    X'X, X'y and y'y of the windows are the differences of their cumulative sums, funds are done chunksize at a time
+    @returns: pd.DataFrame(), index = date, columns = fund ids
+    @factors: pd.DataFrame(), index = date, columns include factorNames
+    @window: int, number of trading days in a window, the window of a date ends on that date
+    @expanding: bool, the window starts on the first date
+    @min_nobs: int, minimum number of days with data in a window, default number of regressors + 1
+    :return: pd.DataFrame(), index = (date, fundid), columns = as regress_batch
+    '''
+    from scipy import stats
+
+    if factorNames is None:
+        factorNames = ["Rm", "Rm2", "HML", "HML2", "SMB", "SMB2"]
+    names = ["const"] + list(factorNames)
+    k = len(names)
+    if min_nobs is None:
+        min_nobs = k + 1
+
+    dates = returns.index.intersection(factors.index).sort_values()
+    x = factors.loc[dates, factorNames].to_numpy(dtype=float)
+    x = np.column_stack([np.ones(len(x)), x])
+    xvalid = ~np.isnan(x).any(axis=1)
+    x = np.where(np.isnan(x), 0.0, x)
+    xx = (x[:, :, None] * x[:, None, :]).reshape(len(x), k * k)
+    T = len(dates)
+
+    def window_sums(cumsum):
+        if expanding:
+            return cumsum
+        sums = cumsum.copy()
+        sums[window:] -= cumsum[:-window]
+        return sums
+
+    results = []
+    for start in range(0, returns.shape[1], chunksize):
+        funds = returns.columns[start:start + chunksize]
+        y = returns.loc[dates, funds].to_numpy(dtype=float)
+        w = (~np.isnan(y) & xvalid[:, None]).astype(float)
+        y = np.where(w > 0, y, 0.0)
+
+        nobs = window_sums(np.cumsum(w, axis=0))
+        XtX = window_sums(np.cumsum(w[:, :, None] * xx[:, None, :], axis=0)).reshape(T, len(funds), k, k)
+        Xty = window_sums(np.cumsum(y[:, :, None] * x[:, None, :], axis=0))
+        yty = window_sums(np.cumsum(y * y, axis=0))
+
+        valid = nobs >= min_nobs
+        if not expanding:
+            valid[:window - 1] = False
+        XtX[~valid] = np.eye(k)
         try:
-            funds = database.Get_Daily_Bar(fundID, instrument_type="mutualfund", datetime1=startdate, datetime2=enddate)
-            if len(funds) < 100:
-                continue
-            funds = pd.DataFrame(funds)
+            XtXinv = np.linalg.inv(XtX)
+        except np.linalg.LinAlgError:
+            XtXinv = np.linalg.pinv(XtX)
+        params = (XtXinv @ Xty[..., None])[..., 0]
+
+        dfresid = nobs - k
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma2 = (yty - (params * Xty).sum(axis=2)) / dfresid
+            bse = np.sqrt(sigma2[..., None] * np.diagonal(XtXinv, axis1=2, axis2=3))
+            tvalues = params / bse
+            pvalues = 2 * stats.t.sf(np.abs(tvalues), dfresid[..., None])
+
+        t, f = np.nonzero(valid)
+        res = pd.DataFrame(np.hstack([params[t, f], tvalues[t, f], pvalues[t, f], nobs[t, f][:, None]]),
+                           index=pd.MultiIndex.from_arrays([dates[t], funds[f]], names=["date", "fundid"]),
+                           columns=names + [n + "_t" for n in names] + [n + "_p" for n in names] + ["nobs"])
+        results.append(res)
+
+    return pd.concat(results).sort_index()
+
+
+@timed(rows=lambda res: int(res.count().sum()))
+def get_fund_returns(database, funds_list, startdate, enddate, max_workers=8, bulk_size=None):
+    '''
+    @database: a database object or a dataFetcher.ConnectionPool, the funds are fetched concurrently from the pool
+    :return: pd.DataFrame(), index = date, columns = fund ids, daily return of adjusted net asset value
+    '''
+    bars, errors = fetch_daily_bars(database, funds_list, "mutualfund", startdate, enddate,
+                                    max_workers=max_workers, bulk_size=bulk_size)
+    for fundID, error in errors.items():
+        print("fund id is:{}, {}".format(fundID, error))
+    fund_returns = {}
+    for fundID, funds in bars.items():
+        if len(funds) < 100:
+            continue
+        try:
+            duplicated = funds["date"].duplicated(keep="last")
+            if duplicated.any():
+                print("fund id is:{}, {} duplicated dates, keeping the last rows".format(fundID, duplicated.sum()))
+                funds = funds[~duplicated].copy()
             funds["return"] = (funds["adjusted_net_asset_value"] - funds[
                 "adjusted_net_asset_value"].shift(periods=1)) / funds["adjusted_net_asset_value"].shift(periods=1)
-            funds = funds[["return", "date"]]
             funds.set_index("date", inplace=True)
-
-            rdf = funds.join([SMB_HML, market_return], how="inner")
-
-            subres = regress(fundID, rdf)
-            res = res.append(subres)
+            fund_returns[fundID] = funds["return"]
         except KeyError:
             print("{} has no data in the given time period".format(fundID))
             continue
-        except Exception:
-            print("fund id is:{}, Unknown Exception".format(fundID))
-            continue
-    res.set_index("fundid", inplace=True)
-    res.to_csv("fund_all.csv")
+    return pd.DataFrame(fund_returns)
 
-def regression_from_download_factors(database):
 
-    startdate = datetime.datetime(2016, 1, 1)
-    enddate = datetime.datetime(2020, 11, 1)
+def get_stock_funds(database):
+    '''
+    :return: list of the symbols of the stock funds
+    '''
+    with as_pool(database).connection() as db:
+        fundlist = db.Get_Instruments_DataFrame(instrument_type="mutualfund",filter={"invest_type1" :'股票型基金'})
+    return list(decode_bytes(fundlist["symbol"]))
+
 
+@timed(rows=None)
+def regression_from_calculated_factors(database, startdate = datetime.datetime(2016, 1, 1),
+                                       enddate = datetime.datetime(2020, 11, 1), normalize = False, store = None):
+    '''
+    @database: a database object or a dataFetcher.ConnectionPool
+    @store: a resultStore.ResultStore or its file name, the results are also written there
+    '''
+    pool = as_pool(database)
 
-    SMB_HML = pd.read_csv("csmar_factor_free_shares.csv")
-    SMB_HML['date'] = SMB_HML['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y/%m/%d"))
-    SMB_HML.set_index("date", inplace=True)
-    SMB_HML["SMB2"] = SMB_HML["SMB"] * SMB_HML["SMB"]
-    SMB_HML["HML2"] = SMB_HML["HML"] * SMB_HML["HML"]
-    SMB_HML["Rm2"] = SMB_HML["Rm"]*SMB_HML["Rm"]
+    #
+    # get_regression_data(database,startdate,enddate,"000002.SZ")
+    all_factors = load_all_factors("calculated", startdate, enddate, database=pool)
     # all_factors.to_csv("all_factors.csv")
-    fundlist = database.Get_Instruments_DataFrame(instrument_type="mutualfund",filter={"invest_type1" :'股票型基金'})
-    fundlist = fundlist[["symbol"]]
-    fundlist["symbol"] = fundlist["symbol"].apply(lambda x: x.decode("utf-8"))
-    funds_list = list(fundlist["symbol"])
-    res = pd.DataFrame()
-    for fundID in tqdm(funds_list):
-        try:
-            funds = database.Get_Daily_Bar(fundID, instrument_type="mutualfund", datetime1=startdate, datetime2=enddate)
-            if len(funds) < 100:
-                continue
-            funds = pd.DataFrame(funds)
-            funds["return"] = (funds["adjusted_net_asset_value"]-funds["adjusted_net_asset_value"].shift(periods=1) ) / funds["adjusted_net_asset_value"].shift(periods=1)
-            funds = funds[["return", "date"]]
-            funds.set_index("date", inplace=True)
+    with pool.connection() as db:
+        fundlist = db.Get_Instruments_DataFrame(instrument_type="mutualfund")  # ,filter={"invest_type1" :'股票型基金'})
+    funds_list = list(decode_bytes(fundlist["symbol"]))
+    returns = get_fund_returns(pool, funds_list, startdate, enddate)
+    res = regress_batch(returns, all_factors, normalize=normalize)
+    res.to_csv("fund_all.csv")
+    if store is not None:
+        save_results(store, res, "calculated", startdate, enddate, normalize)
+    return res
 
-            rdf = funds.join([SMB_HML], how="inner")
+@timed(rows=None)
+def regression_from_download_factors(database, startdate = datetime.datetime(2016, 1, 1),
+                                     enddate = datetime.datetime(2020, 11, 1), normalize = False, store = None):
+    '''
+    @database: a database object or a dataFetcher.ConnectionPool
+    @store: a resultStore.ResultStore or its file name, the results are also written there
+    '''
+    pool = as_pool(database)
 
-            subres = regress(fundID, rdf)
-            res = res.append(subres)
-        except KeyError:
-            print("{} has no data in the given time period".format(fundID))
-            continue
-        except Exception:
-            print("fund id is:{}, Unknown Exception".format(fundID))
-            continue
-    res.set_index("fundid", inplace=True)
+
+    SMB_HML = load_all_factors("download", startdate, enddate)
+    # all_factors.to_csv("all_factors.csv")
+    funds_list = get_stock_funds(pool)
+    returns = get_fund_returns(pool, funds_list, startdate, enddate)
+    res = regress_batch(returns, SMB_HML, normalize=normalize)
     res.to_csv("stockfund_csmar.csv")
+    if store is not None:
+        save_results(store, res, "download", startdate, enddate, normalize)
+    return res
+
+
+def save_results(store, res, source, startdate, enddate, normalize=False, run_id=None):
+    '''
+    write the results of a regression run to a resultStore.ResultStore (or its file name)
+    :return: run_id
+    '''
+    from resultStore import ResultStore
+
+    params = {"source": source, "startdate": startdate, "enddate": enddate, "normalize": normalize}
+    if isinstance(store, ResultStore):
+        return store.write(res, run_id=run_id, params=params)
+    with ResultStore(store) as opened:
+        return opened.write(res, run_id=run_id, params=params)
 
 
 if __name__ == '__main__':
@@ -150,8 +325,9 @@ if __name__ == '__main__':
 
     pathfilename = os.getcwd() + "\..\Config\config2.json"
     config = Config(pathfilename)
-    database = config.DataBase("JDMySQL")
-    regression_from_download_factors(database)
+    pool = ConnectionPool(lambda: config.DataBase("JDMySQL"), size=8)
+    regression_from_download_factors(pool)
+    flush()
     startdate = datetime.datetime(2016,1,1)
     enddate = datetime.datetime(2020,12,1)
 
@@ -0,0 +1,186 @@
+'''
+benchmark of the factor and regression stages on synthetic markets
+
+    python benchmark.py --scales small medium --output bench.csv
+    python benchmark.py --scales small --baseline bench.csv --max-slowdown 1.25
+
+every stage is timed (best of --repeat runs) and run once more under tracemalloc for its peak memory,
+with --baseline the run fails if a stage is slower than max-slowdown times its baseline time
+
+    python benchmark.py --imports --max-import-seconds 0.3
+
+times the import of the modules in fresh interpreters, over the import of pandas and numpy they need anyway,
+and fails if it is over the limit or if they imported one of the optional heavy modules
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import pandas as pd
+
+from syntheticMarket import generate_market, write_market, fund_return_matrix, design_frame
+
+SCALES = {
+    "small": {"nsymbols": 300, "ndays": 120, "nfunds": 50},
+    "medium": {"nsymbols": 1500, "ndays": 500, "nfunds": 500},
+    "large": {"nsymbols": 4000, "ndays": 2500, "nfunds": 8000},
+}
+
+IMPORT_MODULES = ["FamaFrenchTM", "calculateThreeFactors", "factorRegistry", "factorLoader", "fundRegressionRunner"]
+HEAVY_MODULES = ["statsmodels", "scipy", "tqdm", "pyarrow", "MutualFundScore"]
+
+_IMPORT_SCRIPT = """
+import sys, time, json
+import numpy, pandas
+loaded = set(sys.modules)
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy": [m for m in {heavy!r} if m in sys.modules and m not in loaded]}}))
+"""
+
+
+def import_time(modules=IMPORT_MODULES, repeat=5):
+    '''
+    :return: (best seconds to import modules after pandas and numpy in a fresh interpreter, heavy modules imported)
+    '''
+    import json
+
+    script = _IMPORT_SCRIPT.format(modules=list(modules), heavy=HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times, heavy = [], []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True)
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(res["seconds"])
+        heavy = res["heavy"]
+    return min(times), heavy
+
+
+def _stages(market, files, dirname):
+    '''
+    :return: [(name, function)], the functions run the stage on the prepared inputs
+    '''
+    import calculateThreeFactors as ctf
+    import FamaFrenchTM as fftm
+
+    stocks = market["stocks"].rename(columns={"free_float_shares": "CAP"})
+    dates = market["stocks"]["date"]
+    startdate, enddate = dates.min().to_pydatetime(), dates.max().to_pydatetime()
+    holdings = ctf.sort_2x3(market["CAP"], market["PB"])
+    returns = fund_return_matrix(market)
+    design = design_frame(market)
+
+    def get_factors(isSimpleDivided):
+        def run():
+            cwd = os.getcwd()
+            os.chdir(dirname)
+            try:
+                ctf.get_factors(files["stocks"], files["PB"], files["CAP"], startdate, enddate,
+                                isweighted=True, isSimpleDivided=isSimpleDivided)
+            finally:
+                os.chdir(cwd)
+        return run
+
+    def regress_loop():
+        for fundid in returns.columns:
+            df = returns[[fundid]].rename(columns={fundid: "return"}).join(design, how="inner")
+            fftm.regress(fundid, df)
+
+    def statsmodels_loop():
+        # the GLS fit regress() ran for every fund before it used regress_batch, the reference of both
+        import statsmodels.api as sm
+
+        for fundid in returns.columns:
+            df = returns[[fundid]].rename(columns={fundid: "return"}).join(design, how="inner").dropna()
+            model = sm.GLS(df[["return"]], sm.add_constant(df[design.columns])).fit()
+            pd.concat([model.params, model.tvalues.add_suffix("_t"), model.pvalues.add_suffix("_p")])
+
+    return [
+        ("get_factors", get_factors(True)),
+        ("get_factors_2x3", get_factors(False)),
+        ("get_2x3_portfolio", lambda: ctf.get_2x3_portfolio(market["CAP"], market["PB"])),
+        ("sort_2x3", lambda: ctf.sort_2x3(market["CAP"], market["PB"])),
+        ("calc_factors_2x3_divided", lambda: ctf.calc_factors_2x3_divided(holdings, stocks.copy())),
+        ("regress", regress_loop),
+        ("regress_statsmodels", statsmodels_loop),
+        ("regress_batch", lambda: fftm.regress_batch(returns, design)),
+    ]
+
+
+def measure(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run_benchmark(scales, repeat=3, stages=None, seed=0):
+    '''
+    :return: pd.DataFrame(), columns = "scale","stage","seconds","peak_mb" and the sizes of the scale
+    '''
+    rows = []
+    for scale in scales:
+        sizes = SCALES[scale]
+        market = generate_market(seed=seed, **sizes)
+        with tempfile.TemporaryDirectory() as dirname:
+            files = write_market(market, dirname, database=False)
+            for name, func in _stages(market, files, dirname):
+                if stages and name not in stages:
+                    continue
+                # the first call also builds the parquet cache, it is not timed
+                func()
+                seconds, peak = measure(func, repeat)
+                rows.append(dict(sizes, scale=scale, stage=name, seconds=seconds, peak_mb=peak / 2 ** 20))
+                print("{:8s} {:26s} {:10.3f}s {:10.1f}MB".format(scale, name, seconds, peak / 2 ** 20))
+    return pd.DataFrame(rows)
+
+
+def compare(result, baseline, max_slowdown):
+    '''
+    :return: pd.DataFrame(), the stages slower than max_slowdown times the baseline
+    '''
+    merged = result.merge(baseline, on=["scale", "stage"], suffixes=("", "_baseline"))
+    merged["slowdown"] = merged["seconds"] / merged["seconds_baseline"]
+    return merged[merged["slowdown"] > max_slowdown][["scale", "stage", "seconds", "seconds_baseline", "slowdown"]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark the factor and regression stages")
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=list(SCALES))
+    parser.add_argument("--stages", nargs="+", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="csv file of the results")
+    parser.add_argument("--baseline", default=None, help="csv file of an earlier run to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=1.25)
+    parser.add_argument("--kernels", default=None, help="kernel backend of sortKernels: pandas, numpy or numba")
+    parser.add_argument("--imports", action="store_true", help="only check the import time")
+    parser.add_argument("--max-import-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.imports:
+        seconds, heavy = import_time(repeat=args.repeat)
+        print("import {:.3f}s, heavy modules: {}".format(seconds, heavy or "none"))
+        sys.exit(1 if heavy or seconds > args.max_import_seconds else 0)
+
+    if args.kernels:
+        from sortKernels import set_backend
+        set_backend(args.kernels)
+    result = run_benchmark(args.scales, args.repeat, args.stages)
+    if args.output:
+        result.to_csv(args.output, index=False)
+    if args.baseline:
+        slower = compare(result, pd.read_csv(args.baseline), args.max_slowdown)
+        if len(slower):
+            print(slower.to_string(index=False))
+            sys.exit(1)
@@ -0,0 +1,163 @@
+'''
+breakpoints of the daily cross-sectional sorts without sorting the cross-sections
+
+modes:
+    "sort": the full (date, value) sort of sort_size/sort_value, the default
+    "partition": exact, the order statistics at the breakpoints are selected with np.partition, O(n) per date.
+                 ties at the lowest and highest breakpoints are split in row order, as the stable sort does,
+                 so the buckets are the same as the "sort" mode
+
+the mode is chosen with set_mode(), use_mode() or the environment variable FFTM_BREAKPOINTS. every sort logs its
+mode, write_metadata() saves them next to the factor output
+'''
+import os
+import json
+import contextlib
+import numpy as np
+import pandas as pd
+
+from sortKernels import _top_fractions
+
+MODES = ("sort", "partition")
+
+_mode = os.environ.get("FFTM_BREAKPOINTS", "sort")
+_log = []
+
+
+def set_mode(name):
+    global _mode
+    if name not in MODES:
+        raise ValueError("unknown breakpoint mode {}, use one of {}".format(name, MODES))
+    _mode = name
+
+
+def get_mode():
+    return _mode
+
+
+@contextlib.contextmanager
+def use_mode(name):
+    previous = _mode
+    set_mode(name)
+    try:
+        yield
+    finally:
+        set_mode(previous)
+
+
+def _segments(days):
+    '''
+    days: sorted int codes
+    :return: start of every run of equal codes, with len(days) at the end
+    '''
+    return np.flatnonzero(np.r_[True, np.diff(days) != 0, True]) if len(days) else np.array([0])
+
+
+def _order_statistics(num, breakpoints):
+    '''
+    0-based positions, in the sorted date, of the values the buckets are cut at, as in sortKernels.bucket_codes:
+    the last value of the lowest bucket, the values around every middle bucket, the first of the highest bucket
+    :return: np.array, dates x (2 * len(breakpoints)), and the sizes of the lowest and highest buckets
+    '''
+    num = np.asarray(num, dtype=np.int64)
+    low = [(num * b).astype(np.int64) for b in breakpoints]
+    high = [num - (num * top).astype(np.int64) for top in _top_fractions(breakpoints)]
+    columns = [np.maximum(low[0] - 1, 0)]
+    for j in range(1, len(breakpoints)):
+        columns += [np.maximum(low[j - 1], 1) - 1, np.minimum(high[j], num - 1)]
+    columns.append(np.minimum(high[-1], num - 1))
+    return np.column_stack(columns), low[0], num - high[-1]
+
+
+def _assign(days, values, cuts, lowSize, highSize):
+    '''
+    days: date code of every row, rows of a date in row order
+    cuts: dates x columns of _order_statistics, the values at those positions
+    the ties at the lowest and highest cut are split in row order
+    :return: np.array of int8, bucket of every row
+    '''
+    nbp = cuts.shape[1] // 2
+    codes = np.full(len(values), -1, dtype=np.int8)
+    for j in range(1, nbp):
+        codes[(values > cuts[days, 2 * j - 1]) & (values < cuts[days, 2 * j])] = j
+
+    lowCut, highCut = cuts[days, 0], cuts[days, -1]
+    ndays = len(cuts)
+    lowTies = values == lowCut
+    highTies = values == highCut
+    lowNeed = lowSize - np.bincount(days, weights=values < lowCut, minlength=ndays).astype(np.int64)
+    highNeed = highSize - np.bincount(days, weights=values > highCut, minlength=ndays).astype(np.int64)
+    # rank of every tie in row order within its date
+    starts = np.searchsorted(days, np.arange(ndays))
+    lowRank = np.cumsum(lowTies) - lowTies
+    lowRank = lowRank - lowRank[starts][days]
+    highRank = np.cumsum(highTies) - highTies
+    highRank = highRank - highRank[starts][days]
+    highTotal = np.bincount(days, weights=highTies, minlength=ndays).astype(np.int64)
+    isLow = (values < lowCut) | (lowTies & (lowRank < lowNeed[days]))
+    isHigh = (values > highCut) | (highTies & (highTotal[days] - highRank - 1 < highNeed[days]))
+    codes[isLow & (lowSize[days] > 0)] = 0
+    codes[isHigh & (highSize[days] > 0)] = nbp
+    return codes
+
+
+def _partition_cuts(values, starts, positions):
+    cuts = np.empty(positions.shape)
+    for d in range(len(starts) - 1):
+        segment = values[starts[d]:starts[d + 1]]
+        kth = np.unique(positions[d])
+        cuts[d] = np.partition(segment, kth)[positions[d]]
+    return cuts
+
+
+def breakpoint_buckets(dates, values, breakpoints, min_count=0, mode=None):
+    '''
+    the buckets of sortKernels.sort_buckets without sorting the values
+    dates: array of the dates, values: float array without NaN
+    mode: "partition", default the mode set
+    :return: np.array of int8, bucket of every row in the given order, -1 for rows in no bucket and the rows of
+             dates with less than min_count rows
+    '''
+    mode = _mode if mode is None else mode
+    if mode != "partition":
+        raise ValueError("breakpoint_buckets needs the partition mode, not {}".format(mode))
+    values = np.asarray(values, dtype=float)
+    days = pd.factorize(np.asarray(dates), sort=True)[0]
+    # stable, linear if the panel is already in date order
+    order = np.argsort(days, kind="stable")
+    days = days[order]
+    sortedValues = values[order]
+    starts = _segments(days)
+    num = np.diff(starts)
+    positions, lowSize, highSize = _order_statistics(num, breakpoints)
+    cuts = _partition_cuts(sortedValues, starts, positions)
+
+    sortedCodes = _assign(days, sortedValues, cuts, lowSize, highSize)
+    sortedCodes[(num < min_count)[days]] = -1
+    codes = np.empty_like(sortedCodes)
+    codes[order] = sortedCodes
+    _log.append({"mode": mode, "breakpoints": list(breakpoints), "dates": int(len(num)), "rows": int(len(values))})
+    return codes
+
+
+def reset_log():
+    del _log[:]
+
+
+def metadata():
+    '''
+    :return: dict, the mode set and every sort logged since reset_log()
+    '''
+    return {"mode": _mode, "sorts": list(_log)}
+
+
+def metadata_filename(filename):
+    return filename + ".json"
+
+
+def write_metadata(filename):
+    '''
+    save metadata() next to the output filename, as <filename>.json
+    '''
+    with open(metadata_filename(filename), "w") as f:
+        json.dump(metadata(), f, indent=1)
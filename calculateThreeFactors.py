@@ -1,10 +1,15 @@
+import os
 import datetime
 import pandas as pd
 import numpy as np
-from MutualFundScore.common import *
 import gc
-from tqdm import tqdm
-import statsmodels.api as sm
+from dataCache import read_panel, panel_dates, write_panel, _has_pyarrow
+from dataFetcher import as_pool, fetch_daily_bars
+from symbolCodec import SymbolDateCodec, decode_bytes
+from sortKernels import get_backend, sort_buckets, group_reduce
+from breakpointEngine import get_mode, breakpoint_buckets, reset_log, write_metadata
+from holdingsStore import HoldingsStore, write_holdings
+from stageMetrics import timed, flush
 
 
 
@@ -18,278 +23,418 @@ def calc_group_return(df,targetname, isweighted):
         group.rename(columns={"return": targetname}, inplace=True)
     return group[[targetname]]
 
-def get_2x3_portfolio(CAPData,PBData):
+
+def _rank_by_date(data, min_count):
     '''
-        :
-        :return:[{"date":"2020-01-10","SV":[],"SN":[],"SG":[],"BV":[],"BN":[],"BG":[]}]
+    rank the "value" of every date in one pass
+    :return: data with "pos" (position in the ascending sort of its date) and "num" (stocks of its date),
+             dates with less than min_count stocks are dropped
+    '''
+    data = data.sort_values(["date", "value"], kind="mergesort")
+    grouped = data.groupby("date", sort=False)
+    data["pos"] = grouped.cumcount().to_numpy()
+    data["num"] = grouped["value"].transform("size").to_numpy()
+    return data[data["num"] >= min_count].copy()
+
+
+@timed()
+def sort_size(CAPData, min_count=100):
+    '''
+    :return: pd.DataFrame(), columns = "date","symbol","group", group is "S" (small half) or "B" (big half)
+    '''
+    CAPData = CAPData[['date', 'symbol', 'value']].dropna(subset=["value"])
+    if get_mode() != "sort":
+        return _breakpoint_sort(CAPData, [0.5], ["S", "B"], min_count)
+    if get_backend() != "pandas":
+        return _kernel_sort(CAPData, [0.5], ["S", "B"], min_count)
+    CAPData = _rank_by_date(CAPData, min_count)
+    subNum = (CAPData["num"] * 0.5).astype(int)
+    group = np.full(len(CAPData), "", dtype=object)
+    group[(CAPData["pos"] < subNum).to_numpy()] = "S"
+    group[(CAPData["pos"] >= CAPData["num"] - subNum).to_numpy()] = "B"
+    CAPData["group"] = group
+    CAPData = CAPData[CAPData["group"] != ""]
+    return _membership(CAPData)
+
+
+@timed()
+def sort_value(PBData, min_count=100, positive=True, neutral=False):
+    '''
+    PB data is price to book, so the value group is the lowest 30% and the growth group the highest 30%
+    positive: only stocks with PB > 0 are sorted
+    neutral: the stocks between the 30% and 70% breakpoints form the neutral group
+    :return: pd.DataFrame(), columns = "date","symbol","group", group is "V", "N" or "G"
+    '''
+    PBData = PBData[['date', 'symbol', 'value']]
+    if positive:
+        PBData = PBData[PBData['value'] > 0]
+    else:
+        PBData = PBData.dropna(subset=["value"])
+    if get_mode() != "sort":
+        return _breakpoint_sort(PBData, [0.3, 0.7], ["V", "N" if neutral else "", "G"], min_count)
+    if get_backend() != "pandas":
+        return _kernel_sort(PBData, [0.3, 0.7], ["V", "N" if neutral else "", "G"], min_count)
+    PBData = _rank_by_date(PBData, min_count)
+    pos = PBData["pos"].to_numpy()
+    num = PBData["num"].to_numpy()
+    value = PBData["value"].to_numpy()
+    subNum = (num * 0.3).astype(int)
+
+    group = np.full(len(PBData), "", dtype=object)
+    if neutral:
+        # p1 is the last PB of the value group, p2 the first PB of the growth group
+        start = np.arange(len(PBData)) - pos
+        p1 = value[start + subNum - 1]
+        p2 = value[start + num - subNum]
+        group[(value > p1) & (value < p2)] = "N"
+    group[pos < subNum] = "V"
+    group[pos >= num - subNum] = "G"
+    PBData["group"] = group
+    PBData = PBData[PBData["group"] != ""]
+    return _membership(PBData)
+
+
+def _kernel_sort(data, breakpoints, labels, min_count):
+    '''
+    sort_size/sort_value on the kernels of sortKernels, the table is the same as the pandas version
+    labels: label of every bucket, "" for a bucket left out
+    '''
+    order, codes = sort_buckets(data["date"].to_numpy(), data["value"].to_numpy(), breakpoints, min_count)
+    group = np.array(labels, dtype=object)[codes]
+    keep = (codes >= 0) & (group != "")
+    data = data.iloc[order[keep]].assign(group=group[keep])
+    return _membership(data)
+
+
+def _breakpoint_sort(data, breakpoints, labels, min_count):
+    '''
+    sort_size/sort_value with the breakpoints of breakpointEngine, the rows of a date are in their input order
+    instead of the order of the values
+    labels: label of every bucket, "" for a bucket left out
+    '''
+    dates = data["date"].to_numpy()
+    codes = breakpoint_buckets(dates, data["value"].to_numpy(), breakpoints, min_count)
+    group = np.array(labels, dtype=object)[codes]
+    keep = np.flatnonzero((codes >= 0) & (group != ""))
+    keep = keep[np.argsort(dates[keep], kind="stable")]
+    data = data.iloc[keep].assign(group=group[keep])
+    return _membership(data)
+
+
+def combine_2x3(sizeTable, valueTable, datelist):
+    '''
+    intersect the latest size sort and the latest value sort on or before every date of datelist
+    :return: pd.DataFrame(), columns = "date","symbol","group", group is "SV","SN","SG","BV","BN","BG"
+    '''
+    datelist = pd.DatetimeIndex(sorted(datelist))
+    sizeDates = pd.DatetimeIndex(sizeTable["date"].drop_duplicates().sort_values())
+    valueDates = pd.DatetimeIndex(valueTable["date"].drop_duplicates().sort_values())
+    sizepos = sizeDates.searchsorted(datelist, side="right") - 1
+    valuepos = valueDates.searchsorted(datelist, side="right") - 1
+    started = (sizepos >= 0) & (valuepos >= 0)
+
+    dates = pd.DataFrame({"date": datelist[started],
+                          "sizedate": sizeDates[sizepos[started]],
+                          "valuedate": valueDates[valuepos[started]]})
+    size = sizeTable.rename(columns={"date": "sizedate", "group": "size"})
+    value = valueTable.rename(columns={"date": "valuedate", "group": "value"})
+    holdings = dates.merge(size, on="sizedate").merge(value, on=["valuedate", "symbol"])
+    holdings["group"] = holdings["size"].astype(str) + holdings["value"].astype(str)
+    return _membership(holdings)
+
+
+@timed()
+def sort_2x3(CAPData, PBData):
+    '''
+    the 2x3 sort of Fama-French(1993): size is split at 50%, PB at 30% and 70%
+    a date whose CAP or PB data has not more than 100 stocks keeps the previous sort of that variable
+    :return: pd.DataFrame(), columns = "date","symbol","group"
     '''
+    return combine_2x3(*_sort_2x3_tables(CAPData, PBData))
 
-    holdings =[]
-
-    PBdatelist = PBData["date"].drop_duplicates()
-    PBdatelist =sorted(PBdatelist)
-    CAPdatelist = CAPData["date"].drop_duplicates()
-    CAPdatelist = sorted(CAPdatelist)
-
-    startdate = max(PBdatelist[0],CAPdatelist[0])
-
-    datelist = list(set(PBdatelist+CAPdatelist))
-    datelist =list(sorted(datelist))
-
-    startpoint = datelist.index(startdate)
-    datelist =datelist[startpoint:]
-
-    isCAPstart = 0
-    isPBstart =0
-    for date in datelist:
-        CAPsub = CAPData[CAPData['date'] == date]
-        CAPsub.dropna(axis='index', how='all', subset=["value"], inplace=True)
-        CAPsub =CAPsub.sort_values(by='value')
-        if len(CAPsub) > 100:
-            isCAPstart=1
-            subNum =int(len(CAPsub)*0.5)
-            Big = CAPsub.tail(subNum)
-            Small =CAPsub.head(subNum)
-            Big = list(Big["symbol"])
-            Small =list(Small["symbol"])
-
-        PBsub = PBData[PBData['date'] == date]
-        PBsub.dropna(axis='index', how='all', subset=["value"], inplace=True)
-        PBsub = PBsub.sort_values(by='value')
-        if len(PBsub) > 100:
-            isPBstart = 1
-            subNum = int(len(PBsub) * 0.3)
-            # 数据库里面是price to book,SMB是book to price来排序
-            Value = PBsub.head(subNum)
-            Growth = PBsub.tail(subNum)
-            p1 = float(Value.tail(1)['value'])
-            p2 = float(Growth.head(1)['value'])
-            Neutral = PBsub.loc[PBsub["value"]<p2][PBsub["value"]>p1]
-            Growth = list(Growth["symbol"])
-            Value = list(Value["symbol"])
-            Neutral = list(Neutral["symbol"])
-        if isCAPstart*isPBstart ==0:
-            continue
-        SV =list(set(Small).intersection(set(Value)))
-        SN =list(set(Small).intersection(set(Neutral)))
-        SG =list(set(Small).intersection(set(Growth)))
-
-        BV =list(set(Big).intersection(set(Value)))
-        BN =list(set(Big).intersection(set(Neutral)))
-        BG =list(set(Big).intersection(set(Growth)))
-
-        res = {"date":date,"SV":SV,"SN":SN,"SG":SG,"BV":BV,"BN":BN,"BG":BG}
 
+def _sort_2x3_tables(CAPData, PBData, start=True):
+    if start:
+        startdate = max(PBData["date"].min(), CAPData["date"].min())
+        CAPData = CAPData[CAPData["date"] >= startdate]
+        PBData = PBData[PBData["date"] >= startdate]
+    datelist = pd.concat([CAPData["date"], PBData["date"]]).drop_duplicates()
+
+    sizeTable = sort_size(CAPData, min_count=101)
+    valueTable = sort_value(PBData, min_count=101, positive=False, neutral=True)
+    return sizeTable, valueTable, datelist
+
+
+def _membership(data):
+    data = data[["date", "symbol", "group"]].reset_index(drop=True)
+    data["group"] = data["group"].astype("category")
+    return data
+
+
+def membership_to_holdings(membership, keys):
+    '''
+    adapter from the long membership table to the list of symbol lists per date
+    keys: {"S_portfolio": "S", "B_portfolio": "B"}, key of the output dict to group in the table
+    :return: [{"date": date, key: [symbols]}]
+    '''
+    holdings = []
+    for date, sub in membership.groupby("date", sort=True):
+        lists = sub.groupby("group", observed=True)["symbol"].agg(list)
+        res = {"date": date}
+        for key, group in keys.items():
+            res[key] = lists.get(group, [])
         holdings.append(res)
     return holdings
 
+
+@timed()
+def get_2x3_portfolio(CAPData,PBData):
+    '''
+        :
+        :return:[{"date":"2020-01-10","SV":[],"SN":[],"SG":[],"BV":[],"BN":[],"BG":[]}]
+    '''
+    keys = {group: group for group in ["SV", "SN", "SG", "BV", "BN", "BG"]}
+    return membership_to_holdings(sort_2x3(CAPData, PBData), keys)
+
+@timed()
 def get_SMB_portfolio(CAPData):
     '''
     :
     :return:[{"date":"2020-01-10","S_portfolio":["000001.SZ","000002.SZ"],"B_portfolio":["000005.SH","3000015.SH"]}]
 
     '''
+    return membership_to_holdings(sort_size(CAPData), {"B_portfolio": "B", "S_portfolio": "S"})
 
-    #if datetime does not exists: return null
-    #else: calc
-    # CAPData = database.GetDataFrame("factor", "lncap")
-    # CAPData =CAPData[CAPData["date"]>=startdate & CAPData["date"]<=enddate]
-    datelist = CAPData["date"].drop_duplicates()
-    SMB_porfolio =[]
-    for date in datelist:
-        CAPsub = CAPData[CAPData['date'] == date]
-        CAPsub.dropna(axis='index', how='all', subset=["value"], inplace=True)
-        CAPsub =CAPsub.sort_values(by='value')
-        Num = len(CAPsub)
-        if Num < 100: continue
-        subNum =int(Num*0.5)
-        Big_size = CAPsub.tail(subNum)
-        Small_size =CAPsub.head(subNum)
-        res = {"date":date,"B_portfolio":list(Big_size["symbol"]),"S_portfolio":list(Small_size["symbol"])}
-        SMB_porfolio.append(res)
-
-
-    return SMB_porfolio
-
+@timed()
 def get_HML_portfolio(PBData):
     '''
     :
     :return:[{"date":"2020-01-10","H_portfolio":["000001.SZ","000002.SZ"],"L_portfolio":["000005.SH","3000015.SH"]}]
 
     '''
+    return membership_to_holdings(sort_value(PBData), {"H_portfolio": "V", "L_portfolio": "G"})
 
-    # if datetime does not exists: return null
-    # else: calc
-    # PBData = database.GetDataFrame("factor", "pb_lf")
-    # PBData = PBData[PBData["date"] >= startdate & PBData["date"] <= enddate]
-    datelist = PBData["date"].drop_duplicates()
-    datelist =sorted(datelist)
-    HML_porfolio = []
-    for date in datelist:
-        PBsub = PBData[PBData['date'] == date]
-        PBsub = PBsub.sort_values(by='value')
-        PBsub = PBsub[PBsub['value']>0]
-        Num = len(PBsub)
-        subNum = int(Num*0.3)
-        if Num<100:continue
-        Growth = PBsub.tail(subNum)
-        Value = PBsub.head(subNum)
-        res = {"date": date, "H_portfolio": list(Value["symbol"]), "L_portfolio": list(Growth["symbol"])}
-        HML_porfolio.append(res)
 
-    return HML_porfolio
+def holdings_to_membership(holdings, keys):
+    '''
+    adapter from the list of symbol lists per date to the long membership table, see membership_to_holdings
+    '''
+    frames = [pd.DataFrame({"date": line["date"], "symbol": list(line[key]), "group": group})
+              for line in holdings for key, group in keys.items()]
+    return _membership(pd.concat(frames, ignore_index=True))
 
 
+def assign_formation(stockdf, formationDates, lastPeriod=False):
+    '''
+    as-of match of every stock row to the latest formation date on or before its date
+    a portfolio holds from its formation date until the next one
+    lastPeriod: the portfolio of the last formation date holds on, otherwise the period after it is not used
+    :return: np.array, position of the formation date of each row, -1 if the row is in no period
+    '''
+    formationDates = np.sort(np.asarray(formationDates, dtype="datetime64[ns]"))
+    pos = np.searchsorted(formationDates, stockdf["date"].to_numpy(dtype="datetime64[ns]"), side="right") - 1
+    if not lastPeriod:
+        pos[pos >= len(formationDates) - 1] = -1
+    return pos
+
+
+def group_code_table(membership, memberIds, nsymbols, codec):
+    '''
+    dense (formation day, symbol id) -> group code table of a membership table, -1 if the symbol is in no group
+    memberIds: int symbol id of every row of membership, below nsymbols
+    codec: SymbolDateCodec of the formation dates
+    :return: (np.array of int8, formation days x (nsymbols + 1), the groups of the codes), the last column is for
+             unknown symbols, so table[day, -1] is -1
+    '''
+    groups = membership["group"].astype("category")
+    table = np.full((len(codec.dates), nsymbols + 1), -1, dtype=np.int8)
+    table[codec.encode_dates(membership["date"]), memberIds] = groups.cat.codes.to_numpy()
+    return table, groups.cat.categories
+
+
+@timed()
+def calc_group_returns(stockdf, membership, isweighted, market=False, lastPeriod=False):
+    '''
+    daily return of every group of the membership table with one groupby over (date, group)
+    stockdf: "date","symbol","return","CAP","CAP_return"
+    market: add "Rm", the return of all the stocks in the holding periods
+    :return: pd.DataFrame(), index = date, columns = groups
+    '''
+    if len(membership) == 0:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="date"))
+    codec = SymbolDateCodec(dates=membership["date"])
+    pos = assign_formation(stockdf, codec.dates, lastPeriod)
+    stocks = stockdf[pos >= 0]
+    pos = pos[pos >= 0]
+
+    # dense (formation day, symbol id) -> group code table, the last column is for unknown symbols
+    if pd.api.types.is_integer_dtype(membership["symbol"]) and pd.api.types.is_integer_dtype(stocks["symbol"]):
+        memberIds = membership["symbol"].to_numpy()
+        stockIds = stocks["symbol"].to_numpy()
+        nsymbols = max(memberIds.max(initial=-1), stockIds.max(initial=-1)) + 1
+    else:
+        memberIds = codec.encode_symbols(membership["symbol"], add=True)
+        stockIds = codec.encode_symbols(stocks["symbol"])
+        nsymbols = len(codec.symbols)
+    table, categories = group_code_table(membership, memberIds, nsymbols, codec)
+    groupCodes = table[pos, stockIds]
+
+    ingroup = groupCodes >= 0
+    stocks_in_groups = stocks[ingroup].assign(
+        group=pd.Categorical.from_codes(groupCodes[ingroup], categories))
+
+    def group_return(data, keys):
+        if get_backend() != "pandas":
+            if isweighted:
+                group = group_reduce([data[key] for key in keys], data[["CAP_return", "CAP"]])
+                return group["CAP_return"] / group["CAP"]
+            return group_reduce([data[key] for key in keys], data[["return"]], "mean")["return"]
+        if isweighted:
+            group = data.groupby(keys, observed=True)[["CAP_return", "CAP"]].sum()
+            return group["CAP_return"] / group["CAP"]
+        return data.groupby(keys, observed=True)["return"].mean()
+
+    groups = group_return(stocks_in_groups, ["date", "group"]).unstack("group")
+    groups.columns = list(groups.columns)
+    if market:
+        groups = groups.join(group_return(stocks, ["date"]).rename("Rm"), how="outer")
+    return groups
+
+
+def _as_membership(portfolio, keys):
+    if isinstance(portfolio, pd.DataFrame):
+        return portfolio
+    if isinstance(portfolio, HoldingsStore):
+        return portfolio.to_membership()
+    return holdings_to_membership(portfolio, keys)
+
+
+@timed()
 def calc_facrors_simple_divided(df,SMB_pf,HML_pf,isweighted):
     '''
     df: "date","symbol","return","CAP"
-    SMB_df:
-    HML_df:
+    SMB_pf: membership table of sort_size, its HoldingsStore or the list of get_SMB_portfolio
+    HML_pf: membership table of sort_value, its HoldingsStore or the list of get_HML_portfolio
 
-    return:{"date":[],"SMB":[],"HML":[]}
+    return: pd.DataFrame(), index = date, columns = "high","low","HML","small","big","Rm","SMB"
 
     CAP could be total shares or free shares, depends on user
 
     '''
 
-    #
-
-    df["CAP_return"] = df["CAP"]*df["return"]
-    SMB_df = pd.DataFrame()
-    for i,line in enumerate(SMB_pf):
-        if i ==len(SMB_pf)-1:
-            continue
-
-        date1 = SMB_pf[i]['date']
-        date1 = datetime.datetime.strptime(str(date1), "%Y-%m-%d %H:%M:%S")
-
-
-        date2 = SMB_pf[i+1]['date']
-        date2 = datetime.datetime.strptime(str(date2), "%Y-%m-%d %H:%M:%S")
-
-        sub_df = df[df['date']>=date1][ df['date']<date2]
-        Small = line["S_portfolio"]
-        # Small = [str(i) for i in Small]
-        Big = line["B_portfolio"]
-        # Big =[str(i) for i in Big]
-        Small_df = sub_df[sub_df["symbol"].isin(Small)]
-        Big_df = sub_df[sub_df["symbol"].isin(Big)]
-        #calc SMB
-
-        group_small = calc_group_return(Small_df,"small",isweighted)
-
-        group_big = calc_group_return(Big_df,"big",isweighted)
-        group_market = calc_group_return(sub_df,"Rm",isweighted)
-        SMB = group_small.join([group_big,group_market], how="outer")
-        SMB["SMB"] = SMB["small"] - SMB["big"]
-        SMB_df = SMB_df.append(SMB)
-        del Small_df,Big_df,sub_df,group_small, group_big, SMB
-        gc.collect()
-    # SMB_df.to_csv("SMB.csv")
-
-
-    HML_df = pd.DataFrame()
-    for i, line in enumerate(HML_pf):
-        if i == len(HML_pf) - 1:
-            continue
-        date1 = HML_pf[i]['date']
-        date1 = datetime.datetime.strptime(str(date1), "%Y-%m-%d %H:%M:%S")
-
-        date2 = HML_pf[i + 1]['date']
-        date2 = datetime.datetime.strptime(str(date2), "%Y-%m-%d %H:%M:%S")
-
-        sub_df = df[df['date'] >= date1][df['date'] < date2]
-        High = line["H_portfolio"]
-        High =[str(i) for i in High]
-        Low = line["L_portfolio"]
-        Low =[str(i) for i in Low]
-        High_df = sub_df[sub_df['symbol'].isin(High)]
-        Low_df = sub_df[sub_df["symbol"].isin(Low)]
-        # calc SMB
-
-        group_high = calc_group_return(High_df,"high",isweighted)
-        group_low = calc_group_return(Low_df,"low",isweighted)
-
-        HML = group_high.join([group_low], how="outer")
-        HML["HML"] = HML["high"] - HML["low"]
-        HML_df = HML_df.append(HML)
-        del High_df,Low_df,sub_df,group_high, group_low, HML
-        gc.collect()
-    factors = HML_df.join([SMB_df], how="outer")
+    factors = _simple_divided_factors(df, SMB_pf, HML_pf, isweighted)
     factors.to_csv("factors.csv")
     return factors
 
-def calc_factors_2x3_divided(holding,stockdf):
-
-    # res = {"date": date, "SV": SV, "SN": SN, "SG": SG, "BV": BV, "BN": BN, "BG": BG}
+def _simple_divided_factors(df, SMB_pf, HML_pf, isweighted, lastPeriod=False):
+    df["CAP_return"] = df["CAP"]*df["return"]
+    SMB_pf = _as_membership(SMB_pf, {"S_portfolio": "S", "B_portfolio": "B"})
+    HML_pf = _as_membership(HML_pf, {"H_portfolio": "V", "L_portfolio": "G"})
+    return _hml_frame(df, HML_pf, isweighted, lastPeriod).join([_smb_frame(df, SMB_pf, isweighted, lastPeriod)], how="outer")
+
+def _smb_frame(df, SMB_pf, isweighted, lastPeriod=False):
+    groups = calc_group_returns(df, SMB_pf, isweighted, market=True, lastPeriod=lastPeriod)
+    SMB_df = groups.reindex(columns=["S", "B", "Rm"]).rename(columns={"S": "small", "B": "big"})
+    SMB_df["SMB"] = SMB_df["small"] - SMB_df["big"]
+    return SMB_df
+
+def _hml_frame(df, HML_pf, isweighted, lastPeriod=False):
+    groups = calc_group_returns(df, HML_pf, isweighted, lastPeriod=lastPeriod)
+    HML_df = groups.reindex(columns=["V", "G"]).rename(columns={"V": "high", "G": "low"})
+    HML_df["HML"] = HML_df["high"] - HML_df["low"]
+    return HML_df
+
+@timed()
+def calc_factors_2x3_divided(holding,stockdf,lastPeriod=False):
+    '''
+    holding: membership table of sort_2x3, its HoldingsStore or the list of get_2x3_portfolio
+    stockdf: "date","symbol","return","CAP"
+    lastPeriod: the last holding also holds after its date
+    return: pd.DataFrame(), index = date, columns = "SV","SN","SG","BV","BN","BG","Rm","SMB","HML"
+    '''
     stockdf["CAP_return"] = stockdf["CAP"]*stockdf["return"]
-    factors =pd.DataFrame()
-    for i,line in enumerate(holding):
-        if i ==len(holding)-1:
-            continue
-
-        date1 = holding[i]['date']
-        date1 = datetime.datetime.strptime(str(date1), "%Y-%m-%d %H:%M:%S")
+    groupnames = ["SV", "SN", "SG", "BV", "BN", "BG"]
+    holding = _as_membership(holding, {group: group for group in groupnames})
 
+    groups = calc_group_returns(stockdf, holding, True, market=True, lastPeriod=lastPeriod)
+    groups = groups.reindex(columns=groupnames + ["Rm"])
+    groups["SMB"] = (groups["SV"]+groups["SN"]+groups["SG"] -(groups["BV"]+groups["BN"]+groups["BG"]))/3
+    groups["HML"] = ((groups["SV"]+groups["BV"])-(groups["SG"]+groups["BG"]))/2
+    return groups
 
-        date2 = holding[i+1]['date']
-        date2 = datetime.datetime.strptime(str(date2), "%Y-%m-%d %H:%M:%S")
 
-        sub_df = stockdf[stockdf['date']>=date1][stockdf['date']<date2]
 
-        SV,SN,SG,BV,BN,BG = line['SV'],line['SN'],line['SG'],line['BV'],line['BN'],line['BG']
 
-        SV_df = sub_df[sub_df["symbol"].isin(SV)]
-        SN_df = sub_df[sub_df["symbol"].isin(SN)]
-        SG_df = sub_df[sub_df["symbol"].isin(SG)]
-        BV_df = sub_df[sub_df["symbol"].isin(BV)]
-        BN_df = sub_df[sub_df["symbol"].isin(BN)]
-        BG_df = sub_df[sub_df["symbol"].isin(BG)]
-
-        SVgroup = calc_group_return(SV_df,"SV",True)
-        SNgroup = calc_group_return(SN_df,"SN",True)
-        SGgroup = calc_group_return(SG_df,"SG",True)
-        BVgroup = calc_group_return(BV_df,"BV",True)
-        BNgroup = calc_group_return(BN_df,"BN",True)
-        BGgroup = calc_group_return(BG_df,"BG",True)
-
-        Marketgroup = calc_group_return(sub_df,"Rm",True)
-
-        groups = SVgroup.join([SNgroup,SGgroup,BVgroup,BNgroup,BGgroup,Marketgroup],how="outer" )
-        groups["SMB"] = (groups["SV"]+groups["SN"]+groups["SG"] -(groups["BV"]+groups["BN"]+groups["BG"]))/3
-        groups["HML"] = ((groups["SV"]+groups["BV"])-(groups["SG"]+groups["BG"]))/2
-        factors = factors.append(groups)
-    return factors
-
-
-
-def get_stock_data(database,startdate,enddate):
+def stock_returns(bars, price="close", adjust_factor=None, suspensions="nan", calendar=None):
+    '''
+    daily returns of a long panel of bars in one pass
+    bars: pd.DataFrame(), "date","symbol" and the price columns, the dates of a symbol ascending
+    price: column of the close, e.g. "adjusted_close" for an adjusted close of the database
+    adjust_factor: column of the adjustment factor, the price is multiplied with it to adjust for corporate actions
+    suspensions: "nan": the return of the first bar after trading days without a bar (a suspension) is NaN
+                 "keep": it is the return over the whole gap
+    calendar: the trading days, default the dates with a bar of any symbol
+    :return: (return, gap), np.arrays, gap is the number of trading days without a bar before the row
+    '''
+    close = bars[price].to_numpy(dtype=float)
+    if adjust_factor is not None:
+        close = close * bars[adjust_factor].to_numpy(dtype=float)
+    symbols = pd.factorize(bars["symbol"])[0]
+    dates = bars["date"].to_numpy(dtype="datetime64[ns]")
+    calendar = np.unique(dates) if calendar is None else np.sort(np.asarray(calendar, dtype="datetime64[ns]"))
+
+    # previous bar of the same symbol
+    same = np.r_[False, symbols[1:] == symbols[:-1]]
+    previous = np.r_[np.nan, close[:-1]]
+    previous[~same] = np.nan
+    day = np.searchsorted(calendar, dates)
+    gap = np.r_[0, day[1:] - day[:-1] - 1]
+    gap[~same] = 0
+    returns = (close - previous) / previous
+    if suspensions == "nan":
+        returns[gap > 0] = np.nan
+    elif suspensions != "keep":
+        raise ValueError("suspensions is nan or keep, not {}".format(suspensions))
+    return returns, gap
+
+
+@timed()
+def get_stock_data(database,startdate,enddate,max_workers=8,bulk_size=None,file_name=None,price="close",
+                   adjust_factor=None,suspensions="nan",calendar=None):
     '''
     this function calculates stock return of all the stocks listed in the database and saves data to local address
+    database: a database object or a dataFetcher.ConnectionPool, the bars are fetched concurrently from the pool
+    bulk_size: number of symbols per request if the database supports multi-symbol queries
+    file_name: default stock_data<startdate>to<enddate>.csv, written with its parquet cache of dataCache
+    price, adjust_factor, suspensions, calendar: see stock_returns, by default the return after a suspension is NaN
+    :return: pd.DataFrame(), columns = "date","symbol","return","total_shares","free_float_shares","gap"
     '''
-
-    all_stocks = database.Get_Instruments_DataFrame("stock")
+    pool = as_pool(database)
+    with pool.connection() as db:
+        all_stocks = db.Get_Instruments_DataFrame("stock")
     # all_stocks = database.GetDataFrame("financial_data", "instrument_stock", datetime1=startdate, datetime2=enddate)
-    symbols = all_stocks["symbol"]
-    all_data = pd.DataFrame()
-    for symbol in tqdm(symbols):
-        try:
-            symbol_str = symbol.decode('utf-8')
-            data = database.Get_Daily_Bar_DataFrame(symbol_str, "stock", datetime1=startdate, datetime2=enddate)
-            if len(data)<1:
-                print(symbol_str)
-                continue
-            data["return"] = (data["close"]-data["close"].shift(periods=1)) / data["close"].shift(periods=1)
-            data = data[["date", "symbol", "return","total_shares","free_float_shares"]]
-            all_data = all_data.append(data)
-        except KeyError:
+    symbols = list(decode_bytes(all_stocks["symbol"]))
+    bars, errors = fetch_daily_bars(pool, symbols, "stock", startdate, enddate, method="Get_Daily_Bar_DataFrame",
+                                    max_workers=max_workers, bulk_size=bulk_size)
+    for symbol, error in errors.items():
+        print("{}: {}".format(symbol, error))
+    for symbol_str, data in bars.items():
+        if len(data)<1:
             print(symbol_str)
-            continue
-    all_data["symbol"] = all_data["symbol"].apply(lambda x: x.decode('utf-8'))
-    str_startdate = datetime.date.strftime(startdate,"%Y%m%d")
-    str_enddate = datetime.date.strftime(enddate,"%Y%m%d")
-    file_name = "stock_data{}to{}.csv".format(str_startdate,str_enddate)
-    all_data.to_csv(file_name)
+    columns = ["date", "symbol", price, "total_shares", "free_float_shares"] + ([adjust_factor] if adjust_factor else [])
+    all_data = pd.concat([data[columns] for data in bars.values() if len(data)], ignore_index=True)
+    all_data["symbol"] = decode_bytes(all_data["symbol"])
+    # symbols stay in the order they were fetched, the dates of a symbol ascending
+    order = np.lexsort((all_data["date"].to_numpy(), pd.factorize(all_data["symbol"])[0]))
+    all_data = all_data.iloc[order].reset_index(drop=True)
+
+    all_data["return"], all_data["gap"] = stock_returns(all_data, price, adjust_factor, suspensions, calendar)
+    all_data = all_data[["date", "symbol", "return", "total_shares", "free_float_shares", "gap"]]
+    if file_name is None:
+        str_startdate = datetime.date.strftime(startdate,"%Y%m%d")
+        str_enddate = datetime.date.strftime(enddate,"%Y%m%d")
+        file_name = "stock_data{}to{}.csv".format(str_startdate,str_enddate)
+    write_panel(all_data, file_name)
     return all_data
 
 
@@ -300,7 +445,9 @@ def get_stock_data(database,startdate,enddate):
 
 
 
-def get_factors(stocks_filename,PBdata_filename,CAPdata_filename, startdate,enddate, isweighted = False, isSimpleDivided = True,weightedBy = "free_float_shares"):
+@timed()
+def get_factors(stocks_filename,PBdata_filename,CAPdata_filename, startdate,enddate, isweighted = False, isSimpleDivided = True,weightedBy = "free_float_shares",
+                factors_filename = "allfactors.csv", holdings_dir = None):
     '''
     this function calculates factors using self-write functions
 
@@ -317,43 +464,54 @@ def get_factors(stocks_filename,PBdata_filename,CAPdata_filename, startdate,endd
 
     weightedBy: "free_float_shares"
                 "total_shares"
+
+    factors_filename: where the factors are saved, the breakpoint mode of the sorts goes to <factors_filename>.json
+
+    holdings_dir: the sorts are saved there as holdingsStore directories ("size" and "value", or "2x3")
+                  and the returns are calculated from the saved holdings
+
+    only the rows of the stock, PB and CAP files from startdate to enddate are read, so the first portfolios are
+    formed on the first PB/CAP date on or after startdate and the factors cover startdate to enddate only.
+    the PB/CAP data before startdate is not used; for the factors of the whole files pass their first and last dates
     '''
 
 
     # '''
     str_startdate = datetime.date.strftime(startdate, "%Y%m%d")
     str_enddate = datetime.date.strftime(enddate, "%Y%m%d")
+    reset_log()
 
     # PBData = database.GetDataFrame("factor", "pb_lf", datetime1=startdate, datetime2=enddate)
     # CAPData = database.GetDataFrame("factor", "lncap", datetime1=startdate, datetime2=enddate)
-    PBData = pd.read_csv(PBdata_filename)
-    # PBData['symbol'] = PBData['symbol'].apply(lambda x:x.decode('utf-8'))
-    PBData = PBData[['symbol', 'date', 'value']]
-    PBData['date'] = PBData['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y-%m-%d"))
+    PBData = read_panel(PBdata_filename, ['symbol', 'date', 'value'], startdate, enddate)
+    CAPData = read_panel(CAPdata_filename, ['symbol', 'date', 'value'], startdate, enddate)
 
-    CAPData = pd.read_csv(CAPdata_filename)
-    # CAPData['symbol'] = CAPData['symbol'].apply(lambda x:x.decode('utf-8'))
-    CAPData = CAPData[['symbol','date','value']]
-    CAPData['date'] = CAPData['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y-%m-%d"))
+    # symbols are int32 ids from here on
+    codec = SymbolDateCodec()
+    PBData["symbol"] = codec.encode_symbols(PBData["symbol"], add=True)
+    CAPData["symbol"] = codec.encode_symbols(CAPData["symbol"], add=True)
 
     # CAPData.to_csv(file_name_CAP)
     if isSimpleDivided:
         #step1: get portfolios of each group
 
-        HML_pf = get_HML_portfolio(PBData)
+        HML_pf = sort_value(PBData)
         del PBData
         gc.collect()
 
 
-        SMB_pf = get_SMB_portfolio(CAPData)
+        SMB_pf = sort_size(CAPData)
         del CAPData
         gc.collect()
 
+        if holdings_dir is not None:
+            HML_pf = _save_holdings(os.path.join(holdings_dir, "value"), HML_pf, codec)
+            SMB_pf = _save_holdings(os.path.join(holdings_dir, "size"), SMB_pf, codec)
 
         #step 2: calculate returns of the sub groups
-        stocks = pd.read_csv(stocks_filename)
-        stocks['date'] = stocks['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y-%m-%d"))
+        stocks = read_panel(stocks_filename, ['date', 'symbol', 'return', weightedBy], startdate, enddate)
         stocks["CAP"] = stocks[weightedBy]
+        stocks["symbol"] = codec.encode_symbols(stocks["symbol"], add=True)
 
         factors = calc_facrors_simple_divided(stocks,SMB_pf,HML_pf,isweighted)
         del stocks
@@ -362,31 +520,241 @@ def get_factors(stocks_filename,PBdata_filename,CAPdata_filename, startdate,endd
     else:
         #step1: get portfolios of each group
 
-        holdings = get_2x3_portfolio(CAPData,PBData)
+        holdings = sort_2x3(CAPData,PBData)
 
         del CAPData,PBData
         gc.collect()
 
+        if holdings_dir is not None:
+            holdings = _save_holdings(os.path.join(holdings_dir, "2x3"), holdings, codec)
+
         #step 2: calculate returns of the sub groups
-        str_startdate = datetime.date.strftime(startdate, "%Y%m%d")
-        str_enddate = datetime.date.strftime(enddate, "%Y%m%d")
-        file_name = "stock_data{}to{}.csv".format(str_startdate, str_enddate)
-        stocks = pd.read_csv(file_name)
-        stocks['date'] = stocks['date'].apply(lambda x: datetime.datetime.strptime(x, "%Y-%m-%d"))
+        stocks = read_panel(stocks_filename, ['date', 'symbol', 'return', weightedBy], startdate, enddate)
         stocks["CAP"] = stocks[weightedBy]
+        stocks["symbol"] = codec.encode_symbols(stocks["symbol"], add=True)
         factors = calc_factors_2x3_divided(holdings,stocks)
         del stocks
         gc.collect()
 
     # factors.set_index("date",inplace=True)
-    factors.to_csv("allfactors.csv")
+    factors.to_csv(factors_filename)
+    write_metadata(factors_filename)
 
     return factors
 
 
 
+def _save_holdings(dirname, membership, codec):
+    '''
+    write the membership table and read it back memory mapped, with the ids of codec
+    '''
+    write_holdings(dirname, membership, codec.symbols)
+    return HoldingsStore(dirname).to_membership(codec)
+
+
+def _last_formation(table):
+    return table[table["date"] == table["date"].max()].reset_index(drop=True)
+
+
+def _next_day(date):
+    return None if date is None else date + datetime.timedelta(days=1)
+
+
+@timed()
+def update_factors(stocks_filename,PBdata_filename,CAPdata_filename, isweighted = False, isSimpleDivided = True,
+                   weightedBy = "free_float_shares", state_filename = "factors_state.pkl",
+                   factors_filename = "allfactors.csv"):
+    '''
+    incremental version of get_factors for the nightly update
+
+    the state file keeps the latest size and PB sorts and the last trading day in factors_filename,
+    a run only calculates the trading days after it and appends them to factors_filename,
+    the portfolios are sorted again only if PB/CAP data of a new date has arrived
+
+    unlike get_factors, the portfolios of the latest sort hold until the next sort, so the newest
+    trading days are included
+    the first run (no state file) calculates the whole history and writes factors_filename
+    '''
+    params = {"isweighted": isweighted, "isSimpleDivided": isSimpleDivided, "weightedBy": weightedBy}
+    reset_log()
+    state = pd.read_pickle(state_filename) if os.path.exists(state_filename) else None
+    if state is not None and state["params"] != params:
+        raise ValueError("{} was built with {}, not {}".format(state_filename, state["params"], params))
+
+    if state is None:
+        sizeTable = valueTable = None
+        sizedate = valuedate = lastdate = None
+        codec = SymbolDateCodec()
+    else:
+        sizeTable, valueTable = state["size"], state["value"]
+        sizedate, valuedate, lastdate = state["sizedate"], state["valuedate"], state["lastdate"]
+        codec = state["codec"]
+
+    # only the dates after the previous sort are read and sorted
+    CAPData = read_panel(CAPdata_filename, ['symbol', 'date', 'value'], _next_day(sizedate))
+    PBData = read_panel(PBdata_filename, ['symbol', 'date', 'value'], _next_day(valuedate))
+    CAPData["symbol"] = codec.encode_symbols(CAPData["symbol"], add=True)
+    PBData["symbol"] = codec.encode_symbols(PBData["symbol"], add=True)
+    if isSimpleDivided:
+        newsize, newvalue = sort_size(CAPData), sort_value(PBData)
+        datelist = None
+    else:
+        newsize, newvalue, datelist = _sort_2x3_tables(CAPData, PBData, start=state is None)
+    if len(CAPData):
+        sizedate = CAPData["date"].max()
+    if len(PBData):
+        valuedate = PBData["date"].max()
+    sizeTable = pd.concat([sizeTable, newsize], ignore_index=True) if sizeTable is not None else newsize
+    valueTable = pd.concat([valueTable, newvalue], ignore_index=True) if valueTable is not None else newvalue
+    del CAPData, PBData
+
+    stocks = read_panel(stocks_filename, ['date', 'symbol', 'return', weightedBy], _next_day(lastdate))
+    stocks["CAP"] = stocks[weightedBy]
+    stocks["symbol"] = codec.encode_symbols(stocks["symbol"], add=True)
+    if len(stocks) and len(sizeTable) and len(valueTable):
+        if isSimpleDivided:
+            factors = _simple_divided_factors(stocks, sizeTable, valueTable, isweighted, lastPeriod=True)
+        else:
+            datelist = pd.concat([sizeTable["date"], valueTable["date"], datelist]).drop_duplicates()
+            holdings = combine_2x3(sizeTable, valueTable, datelist)
+            factors = calc_factors_2x3_divided(holdings, stocks, lastPeriod=True)
+        if state is None or not os.path.exists(factors_filename):
+            factors.to_csv(factors_filename)
+        else:
+            factors.to_csv(factors_filename, mode="a", header=False)
+        write_metadata(factors_filename)
+        lastdate = stocks["date"].max()
+    else:
+        factors = pd.DataFrame()
+
+    state = {"params": params, "lastdate": lastdate, "sizedate": sizedate, "valuedate": valuedate, "codec": codec,
+             "size": _last_formation(sizeTable) if len(sizeTable) else sizeTable,
+             "value": _last_formation(valueTable) if len(valueTable) else valueTable}
+    pd.to_pickle(state, state_filename)
+    return factors
+
+
+
+# rough bytes held per stock/PB/CAP row while a batch is processed, copies and merges included
+STREAM_ROW_BYTES = 200
+
+
+def _date_batches(rows, budget_rows):
+    '''
+    rows: pd.Series(), index = dates, values = rows of the date
+    :return: [(startdate, enddate)], consecutive dates with not more than budget_rows rows, at least one date each
+    '''
+    batches = []
+    start, total = None, 0
+    for date, n in rows.items():
+        if start is not None and total + n > budget_rows:
+            batches.append((start, last))
+            start, total = None, 0
+        if start is None:
+            start = date
+        total += n
+        last = date
+    if start is not None:
+        batches.append((start, last))
+    return batches
+
+
+def _valid_sort_dates(filename, startdate, enddate, min_count, positive, budget_rows):
+    '''
+    dates of the panel that sort_size/sort_value do not skip, read batch by batch
+    '''
+    counts = []
+    for start, end in _date_batches(panel_dates(filename)[startdate:enddate], budget_rows):
+        data = read_panel(filename, ['date', 'value'], start, end)
+        valid = data["value"] > 0 if positive else data["value"].notna()
+        counts.append(valid.groupby(data["date"]).sum())
+    counts = pd.concat(counts) if counts else pd.Series(dtype="int64")
+    return counts.index[counts >= min_count]
+
+
+@timed(rows=None)
+def get_factors_streaming(stocks_filename,PBdata_filename,CAPdata_filename, startdate,enddate, isweighted = False,
+                          isSimpleDivided = True,weightedBy = "free_float_shares", memory_budget = 256,
+                          factors_filename = "allfactors.csv"):
+    '''
+    get_factors with bounded memory, the output is the same as get_factors
+
+    the panels are read from the parquet cache in batches of consecutive dates, a batch holds about
+    memory_budget MB of stock, PB and CAP rows; only the latest sort before the batch is kept between batches,
+    and the factors of every batch are appended to factors_filename
+
+    memory_budget: MB
+    needs pyarrow, without the parquet cache every batch would parse the whole csv files again
+    '''
+    if not _has_pyarrow():
+        raise ImportError("get_factors_streaming reads the panels from the parquet cache and needs pyarrow, "
+                          "use get_factors without it")
+    budget_rows = max(int(memory_budget * 2 ** 20 / STREAM_ROW_BYTES), 1)
+    reset_log()
+    stockRows = panel_dates(stocks_filename)[startdate:enddate]
+    CAPRows = panel_dates(CAPdata_filename)[startdate:enddate]
+    PBRows = panel_dates(PBdata_filename)[startdate:enddate]
+
+    # the holding period after the last sort is not used, as in get_factors
+    if isSimpleDivided:
+        sizeEnd = _valid_sort_dates(CAPdata_filename, startdate, enddate, 100, False, budget_rows).max()
+        valueEnd = _valid_sort_dates(PBdata_filename, startdate, enddate, 100, True, budget_rows).max()
+    else:
+        start2x3 = max(CAPRows.index.min(), PBRows.index.min())
+        end2x3 = max(CAPRows.index.max(), PBRows.index.max())
+    rows = pd.concat([stockRows, CAPRows, PBRows], axis=1).fillna(0).sum(axis=1).sort_index()
+
+    sizeTable = valueTable = datelist = None
+    codec = SymbolDateCodec()
+    written = False
+    for start, end in _date_batches(rows, budget_rows):
+        CAPData = read_panel(CAPdata_filename, ['symbol', 'date', 'value'], start, end)
+        PBData = read_panel(PBdata_filename, ['symbol', 'date', 'value'], start, end)
+        CAPData["symbol"] = codec.encode_symbols(CAPData["symbol"], add=True)
+        PBData["symbol"] = codec.encode_symbols(PBData["symbol"], add=True)
+        if isSimpleDivided:
+            newsize, newvalue = sort_size(CAPData), sort_value(PBData)
+        else:
+            CAPData = CAPData[CAPData["date"] >= start2x3]
+            PBData = PBData[PBData["date"] >= start2x3]
+            newsize, newvalue, newdates = _sort_2x3_tables(CAPData, PBData, start=False)
+            datelist = pd.concat([datelist, newdates]).drop_duplicates()
+        sizeTable = pd.concat([sizeTable, newsize], ignore_index=True) if sizeTable is not None else newsize
+        valueTable = pd.concat([valueTable, newvalue], ignore_index=True) if valueTable is not None else newvalue
+        del CAPData, PBData
+
+        stocks = read_panel(stocks_filename, ['date', 'symbol', 'return', weightedBy], start, end)
+        stocks["CAP"] = stocks[weightedBy]
+        stocks["symbol"] = codec.encode_symbols(stocks["symbol"], add=True)
+        stocks["CAP_return"] = stocks["CAP"]*stocks["return"]
+        if isSimpleDivided:
+            HML_df = _hml_frame(stocks[stocks["date"] < valueEnd], valueTable, isweighted, lastPeriod=True)
+            SMB_df = _smb_frame(stocks[stocks["date"] < sizeEnd], sizeTable, isweighted, lastPeriod=True)
+            factors = HML_df.join([SMB_df], how="outer")
+        elif len(sizeTable) and len(valueTable):
+            holdings = combine_2x3(sizeTable, valueTable, datelist)
+            factors = calc_factors_2x3_divided(holdings, stocks[stocks["date"] < end2x3], lastPeriod=True)
+        else:
+            factors = calc_factors_2x3_divided(pd.DataFrame(columns=["date", "symbol", "group"]), stocks.iloc[:0])
+        del stocks
+
+        if len(factors) or not written:
+            factors.to_csv(factors_filename, mode="a" if written else "w", header=not written)
+            written = written or len(factors) > 0
+
+        # keep the latest sorts only
+        if len(sizeTable):
+            sizeTable = _last_formation(sizeTable)
+        if len(valueTable):
+            valueTable = _last_formation(valueTable)
+        gc.collect()
+    write_metadata(factors_filename)
+
+
+
 def get_factors_run(startdate,enddate,stocks_filename,PBdata_filename,CAPdata_filename):
     get_factors(stocks_filename,PBdata_filename,CAPdata_filename,startdate,enddate,isweighted=True,isSimpleDivided=True)
+    flush()
 
 
 
@@ -0,0 +1,257 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+from stageMetrics import timed
+
+CACHE_DIR = ".cache"
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def _cache_paths(filename, cache_dir):
+    name = os.path.basename(filename) + "." + hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, name + ".parquet"), os.path.join(cache_dir, name + ".json")
+
+
+def file_hash(filename, blocksize=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _is_valid(filename, meta_filename, date_format):
+    '''
+    the cache is valid if the source has the same mtime and size, or else the same content hash
+    '''
+    if not os.path.exists(meta_filename):
+        return False
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    if meta["date_format"] != date_format:
+        return False
+    stat = os.stat(filename)
+    if meta["mtime"] == stat.st_mtime and meta["size"] == stat.st_size:
+        return True
+    if meta["size"] != stat.st_size or meta["sha1"] != file_hash(filename):
+        return False
+    # touched but not changed
+    meta["mtime"] = stat.st_mtime
+    with open(meta_filename, "w") as f:
+        json.dump(meta, f)
+    return True
+
+
+def _parse(data, date_format):
+    data = data[[c for c in data.columns if not c.startswith("Unnamed:")]]
+    data["date"] = pd.to_datetime(data["date"], format=date_format)
+    return data
+
+
+def _read_csv(filename, date_format):
+    data = _parse(pd.read_csv(filename), date_format)
+    data["symbol"] = data["symbol"].astype("category")
+    return data
+
+
+def build_cache(filename, date_format="%Y-%m-%d", cache_dir=CACHE_DIR, chunksize=1000000):
+    '''
+    convert a csv panel with "date" and "symbol" columns to parquet, chunksize rows at a time
+    the files are partitioned by year and ordered by date, so a date range only touches a few files and
+    row groups; within a date the rows keep the order of the csv
+    the meta file keeps the number of rows of every date
+    '''
+    import shutil
+
+    os.makedirs(cache_dir, exist_ok=True)
+    parquet_dirname, meta_filename = _cache_paths(filename, cache_dir)
+    if os.path.exists(parquet_dirname):
+        shutil.rmtree(parquet_dirname)
+    stat = os.stat(filename)
+    sha1 = file_hash(filename)
+
+    rows = pd.Series(dtype="int64")
+    for i, chunk in enumerate(pd.read_csv(filename, chunksize=chunksize)):
+        chunk = _parse(chunk, date_format)
+        chunk["symbol"] = chunk["symbol"].astype(str)
+        rows = rows.add(chunk["date"].value_counts(), fill_value=0)
+        _write_parts(chunk, parquet_dirname, i)
+
+    _write_meta(filename, meta_filename, stat, sha1, date_format, rows)
+    return parquet_dirname
+
+
+def _write_parts(chunk, parquet_dirname, part, schema=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for year, sub in chunk.groupby(chunk["date"].dt.year, sort=True):
+        sub = sub.sort_values("date", kind="mergesort")
+        os.makedirs(os.path.join(parquet_dirname, str(year)), exist_ok=True)
+        table = pa.Table.from_pandas(sub, schema=schema, preserve_index=False)
+        pq.write_table(table, os.path.join(parquet_dirname, str(year), "part-{:06d}.parquet".format(part)),
+                       row_group_size=1 << 16)
+
+
+def _write_meta(filename, meta_filename, stat, sha1, date_format, rows):
+    rows = rows.sort_index().astype("int64")
+    meta = {"source": os.path.abspath(filename), "mtime": stat.st_mtime, "size": stat.st_size,
+            "sha1": sha1, "date_format": date_format, "rows": int(rows.sum()),
+            "dates": {date.strftime("%Y-%m-%d"): int(n) for date, n in rows.items()}}
+    with open(meta_filename, "w") as f:
+        json.dump(meta, f)
+
+
+def write_panel(data, filename, date_format="%Y-%m-%d", cache_dir=CACHE_DIR, chunksize=1000000):
+    '''
+    save a panel with "date" and "symbol" columns as the csv filename and put it in the parquet cache directly,
+    the cache is the same as build_cache makes from the csv, without parsing the csv again
+    '''
+    import shutil
+
+    data.to_csv(filename, date_format=date_format)
+    if not _has_pyarrow():
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    parquet_dirname, meta_filename = _cache_paths(filename, cache_dir)
+    if os.path.exists(parquet_dirname):
+        shutil.rmtree(parquet_dirname)
+    # the dates as the csv parse gives them
+    dates, uniques = pd.factorize(data["date"])
+    uniques = pd.to_datetime(pd.DatetimeIndex(uniques).strftime(date_format), format=date_format)
+    data = data.assign(date=uniques[dates], symbol=data["symbol"].astype(str)).reset_index(drop=True)
+    rows = data["date"].value_counts()
+    for i, start in enumerate(range(0, len(data), chunksize)):
+        _write_parts(data.iloc[start:start + chunksize], parquet_dirname, i)
+    _write_meta(filename, meta_filename, os.stat(filename), file_hash(filename), date_format, rows)
+
+
+def _part_files(parquet_dirname):
+    return [os.path.join(parquet_dirname, year, name) for year in sorted(os.listdir(parquet_dirname))
+            for name in sorted(os.listdir(os.path.join(parquet_dirname, year)))]
+
+
+def append_cache(filename, date_format="%Y-%m-%d", cache_dir=CACHE_DIR, blocksize=1 << 20):
+    '''
+    add the rows appended to the csv since the cache was built as new parquet parts, only the tail is parsed
+    the csv must only have grown: its first meta["size"] bytes still hash to meta["sha1"] and end with a newline
+    :return: True if the cache is up to date afterwards, False if it has to be rebuilt
+    '''
+    import io
+    import pyarrow.parquet as pq
+
+    parquet_dirname, meta_filename = _cache_paths(filename, cache_dir)
+    if not (os.path.exists(parquet_dirname) and os.path.exists(meta_filename)):
+        return False
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    stat = os.stat(filename)
+    size = meta["size"]
+    files = _part_files(parquet_dirname)
+    if meta["date_format"] != date_format or stat.st_size <= size or size == 0 or not files:
+        return False
+
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        header = f.readline()
+        f.seek(0)
+        remaining = size
+        while remaining:
+            block = f.read(min(blocksize, remaining))
+            if not block:
+                return False
+            sha1.update(block)
+            remaining -= len(block)
+            last = block[-1:]
+        if last != b"\n" or sha1.hexdigest() != meta["sha1"]:
+            return False
+        tail = f.read(stat.st_size - size)
+    sha1.update(tail)
+
+    rows = pd.Series(meta["dates"], dtype="int64")
+    rows.index = pd.to_datetime(rows.index)
+    if tail.strip():
+        columns = pd.read_csv(io.BytesIO(header), nrows=0).columns
+        data = _parse(pd.read_csv(io.BytesIO(tail), header=None, names=columns), date_format)
+        data["symbol"] = data["symbol"].astype(str)
+        part = 1 + max(int(os.path.basename(name)[5:-8]) for name in files)
+        # the types of the parts already written, a tail without NaN would otherwise give int columns
+        _write_parts(data, parquet_dirname, part, schema=pq.read_schema(files[0]))
+        rows = rows.add(data["date"].value_counts(), fill_value=0)
+    _write_meta(filename, meta_filename, stat, sha1.hexdigest(), date_format, rows)
+    return True
+
+
+def _ensure_cache(filename, date_format, cache_dir):
+    parquet_dirname, meta_filename = _cache_paths(filename, cache_dir)
+    if os.path.exists(parquet_dirname) and _is_valid(filename, meta_filename, date_format):
+        return parquet_dirname, meta_filename
+    # a csv that only had rows appended, as by the nightly update, gets its tail added to the cache
+    if not append_cache(filename, date_format, cache_dir):
+        build_cache(filename, date_format, cache_dir)
+    return parquet_dirname, meta_filename
+
+
+def panel_dates(filename, date_format="%Y-%m-%d", cache_dir=CACHE_DIR):
+    '''
+    :return: pd.Series(), index = dates of the panel, values = number of rows of the date
+    '''
+    if not _has_pyarrow():
+        return _read_csv(filename, date_format)["date"].value_counts().sort_index()
+    parquet_dirname, meta_filename = _ensure_cache(filename, date_format, cache_dir)
+    with open(meta_filename) as f:
+        dates = json.load(f)["dates"]
+    return pd.Series(list(dates.values()), index=pd.to_datetime(list(dates.keys())), dtype="int64")
+
+
+@timed()
+def read_panel(filename, columns=None, startdate=None, enddate=None, date_format="%Y-%m-%d", cache_dir=CACHE_DIR):
+    '''
+    read a csv panel through the local parquet cache, the cache is rebuilt when the csv changes
+    @columns: list, columns to load, None for all
+    @startdate, enddate: datetime, only rows with startdate <= date <= enddate are loaded
+    :return: pd.DataFrame(), "date" is datetime64 and "symbol" is categorical
+    '''
+    if not _has_pyarrow():
+        data = _read_csv(filename, date_format)
+        if startdate is not None:
+            data = data[data["date"] >= pd.Timestamp(startdate)]
+        if enddate is not None:
+            data = data[data["date"] <= pd.Timestamp(enddate)]
+        return data if columns is None else data[columns]
+
+    import pyarrow.dataset as ds
+
+    parquet_dirname, meta_filename = _ensure_cache(filename, date_format, cache_dir)
+    files, skipped = [], []
+    for year in sorted(os.listdir(parquet_dirname)):
+        yeardir = os.path.join(parquet_dirname, year)
+        yearfiles = [os.path.join(yeardir, name) for name in sorted(os.listdir(yeardir))]
+        if (startdate is not None and int(year) < pd.Timestamp(startdate).year) or \
+                (enddate is not None and int(year) > pd.Timestamp(enddate).year):
+            skipped += yearfiles
+        else:
+            files += yearfiles
+    if not files:
+        # nothing in the date range, the filter returns the empty frame with the schema
+        files = skipped[:1]
+    condition = None
+    if startdate is not None:
+        condition = ds.field("date") >= pd.Timestamp(startdate)
+    if enddate is not None:
+        end = ds.field("date") <= pd.Timestamp(enddate)
+        condition = end if condition is None else condition & end
+    dataset = ds.dataset(files, format="parquet")
+    data = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    if "symbol" in data.columns:
+        data["symbol"] = data["symbol"].astype("category")
+    return data
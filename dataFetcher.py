@@ -0,0 +1,215 @@
+import time
+import queue
+import sqlite3
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from stageMetrics import timed
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ConnectionPool(object):
+    '''
+    a bounded pool of database connections shared by the fetching threads
+    factory: function returning a new database object, e.g. lambda: config.DataBase("JDMySQL")
+    connections: already opened database objects
+    '''
+
+    def __init__(self, factory=None, size=8, connections=None):
+        self.factory = factory
+        self.size = size if connections is None else len(connections)
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        for conn in connections or []:
+            self._idle.put(conn)
+            self._created += 1
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self.factory is not None and self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+
+def _timestamp(date):
+    return pd.Timestamp(date).strftime(DATE_FORMAT)
+
+
+def as_pool(database):
+    if isinstance(database, ConnectionPool):
+        return database
+    return ConnectionPool(connections=[database])
+
+
+def _decode(symbol):
+    return symbol.decode('utf-8') if isinstance(symbol, bytes) else symbol
+
+
+def _progress(iterable, total):
+    '''
+    tqdm progress bar if tqdm is installed
+    '''
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable, total=total)
+
+
+def _with_retry(func, retries, backoff):
+    '''
+    KeyError means the symbol has no data and is not retried
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except KeyError:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+@timed(rows=lambda res: sum(len(bars) for bars in res[0].values()))
+def fetch_daily_bars(database, symbols, instrument_type, startdate, enddate, method="Get_Daily_Bar",
+                     max_workers=8, retries=3, backoff=0.5, bulk_size=None, progress=True):
+    '''
+    fetch the daily bars of many symbols concurrently
+    @database: ConnectionPool or a single database object
+    @method: "Get_Daily_Bar" or "Get_Daily_Bar_DataFrame"
+    @max_workers: number of concurrent requests, also bounded by the size of the pool
+    @retries, backoff: a failed request is retried after backoff, 2*backoff, 4*backoff... seconds
+    @bulk_size: fetch bulk_size symbols per request if the database supports Get_Daily_Bar_Multi
+    :return: ({symbol: pd.DataFrame()}, {symbol: error message}), both in the order of symbols
+    '''
+    pool = as_pool(database)
+    max_workers = min(max_workers, pool.size)
+
+    def probe():
+        with pool.connection() as db:
+            return hasattr(db, "Get_Daily_Bar_Multi")
+
+    bulk = bulk_size is not None and _with_retry(probe, retries, backoff)
+
+    def fetch_one(symbol):
+        with pool.connection() as db:
+            return pd.DataFrame(getattr(db, method)(symbol, instrument_type=instrument_type,
+                                                    datetime1=startdate, datetime2=enddate))
+
+    def fetch_many(chunk):
+        with pool.connection() as db:
+            data = db.Get_Daily_Bar_Multi(chunk, instrument_type=instrument_type,
+                                          datetime1=startdate, datetime2=enddate)
+        bars = {_decode(symbol): sub.reset_index(drop=True) for symbol, sub in data.groupby("symbol", sort=False)}
+        return {symbol: bars.get(symbol, pd.DataFrame(columns=data.columns)) for symbol in chunk}
+
+    if bulk:
+        tasks = [symbols[i:i + bulk_size] for i in range(0, len(symbols), bulk_size)]
+    else:
+        tasks = list(symbols)
+
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for task in tasks:
+            func = (lambda t=task: fetch_many(t)) if bulk else (lambda t=task: fetch_one(t))
+            futures[executor.submit(_with_retry, func, retries, backoff)] = task
+        completed = as_completed(futures)
+        if progress:
+            completed = _progress(completed, len(futures))
+        for future in completed:
+            task = futures[future]
+            try:
+                data = future.result()
+            except KeyError:
+                errors.update({symbol: "no data" for symbol in (task if bulk else [task])})
+                continue
+            except Exception as e:
+                errors.update({symbol: repr(e) for symbol in (task if bulk else [task])})
+                continue
+            results.update(data if bulk else {task: data})
+
+    bars = {symbol: results[symbol] for symbol in symbols if symbol in results}
+    errors = {symbol: errors[symbol] for symbol in symbols if symbol in errors}
+    return bars, errors
+
+
+class SQLiteDatabase(object):
+    '''
+    local stand-in for the MySQL source with the methods used by this package
+    tables: instrument(symbol, instrument_type, ...), daily_bar(symbol, instrument_type, date, ...)
+    symbols are returned as bytes like the MySQL source
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+
+    def _query(self, sql, params=()):
+        data = pd.read_sql_query(sql, self.conn, params=params)
+        if "date" in data.columns:
+            data["date"] = pd.to_datetime(data["date"])
+        if "symbol" in data.columns:
+            data["symbol"] = data["symbol"].str.encode('utf-8')
+        return data
+
+    def Get_Instruments_DataFrame(self, instrument_type, filter=None):
+        sql = "SELECT * FROM instrument WHERE instrument_type = ?"
+        params = [instrument_type]
+        for key, value in (filter or {}).items():
+            sql += " AND {} = ?".format(key)
+            params.append(value)
+        return self._query(sql, params)
+
+    def Get_Daily_Bar_DataFrame(self, symbol, instrument_type, datetime1, datetime2):
+        data = self._query("SELECT * FROM daily_bar WHERE symbol = ? AND instrument_type = ? AND date >= ? AND date <= ? "
+                           "ORDER BY date", [symbol, instrument_type, _timestamp(datetime1), _timestamp(datetime2)])
+        return data.drop(columns=["instrument_type"])
+
+    def Get_Daily_Bar(self, symbol, instrument_type, datetime1, datetime2):
+        return self.Get_Daily_Bar_DataFrame(symbol, instrument_type, datetime1, datetime2).to_dict("records")
+
+    def Get_Daily_Bar_Multi(self, symbols, instrument_type, datetime1, datetime2):
+        sql = ("SELECT * FROM daily_bar WHERE symbol IN ({}) AND instrument_type = ? AND date >= ? AND date <= ? "
+               "ORDER BY symbol, date").format(",".join("?" * len(symbols)))
+        data = self._query(sql, list(symbols) + [instrument_type, _timestamp(datetime1), _timestamp(datetime2)])
+        return data.drop(columns=["instrument_type"])
+
+
+def write_sqlite_database(filename, instruments, bars):
+    '''
+    instruments: pd.DataFrame(), columns include "symbol","instrument_type"
+    bars: pd.DataFrame(), columns include "symbol","instrument_type","date"
+    '''
+    conn = sqlite3.connect(filename)
+    bars = bars.assign(date=pd.to_datetime(bars["date"]).dt.strftime(DATE_FORMAT))
+    instruments.to_sql("instrument", conn, if_exists="replace", index=False)
+    bars.to_sql("daily_bar", conn, if_exists="replace", index=False)
+    conn.execute("CREATE INDEX IF NOT EXISTS bar_symbol_date ON daily_bar (symbol, instrument_type, date)")
+    conn.commit()
+    conn.close()
@@ -0,0 +1,118 @@
+'''
+memoized loader of the all_factors design frame of the regressions
+
+a frame is kept in an in-process LRU and pickled under .cache/factors, keyed by the source, the mtime and size
+of its file, the date range and the transforms, so repeated regression runs skip the factor loading.
+the index bars of the "calculated" source come from the database, which has no mtime: pass refresh=True
+after the database has changed
+'''
+import os
+import json
+import hashlib
+import collections
+import pandas as pd
+
+from dataCache import CACHE_DIR
+
+MEMORY_SIZE = 16
+DISK_SIZE = 64
+DEFAULT_TRANSFORMS = ("Rm2", "SMB2", "HML2")
+
+_memory = collections.OrderedDict()
+
+
+def read_download_factors(filename, date_format="%Y/%m/%d"):
+    '''
+    :return: pd.DataFrame(), index = date, columns = the columns of the csv, e.g. "Rm","SMB","HML"
+    '''
+    factors = pd.read_csv(filename)
+    factors["date"] = pd.to_datetime(factors["date"], format=date_format)
+    return factors.set_index("date")
+
+
+def read_calculated_factors(database, startdate, enddate, filename="factors.csv", index="000001.SH",
+                            date_format="%Y/%m/%d"):
+    '''
+    "Rm" of the index bars joined with "SMB","HML" of the factors file of calculateThreeFactors
+    @database: a database object or a dataFetcher.ConnectionPool
+    :return: pd.DataFrame(), index = date, columns = "Rm","SMB","HML"
+    '''
+    from dataFetcher import as_pool
+
+    with as_pool(database).connection() as db:
+        market_return = pd.DataFrame(db.Get_Daily_Bar(index, instrument_type="Index", datetime1=startdate,
+                                                      datetime2=enddate))
+    previous = market_return["close"].shift(periods=1)
+    market_return["Rm"] = (market_return["close"] - previous) / previous
+    market_return = market_return[["date", "Rm"]].set_index("date")
+    SMB_HML = read_download_factors(filename, date_format)[["SMB", "HML"]]
+    return market_return.join([SMB_HML], how="inner")
+
+
+def _key(source, filename, startdate, enddate, transforms, index):
+    stat = os.stat(filename)
+    return json.dumps({"source": source, "filename": os.path.abspath(filename), "mtime": stat.st_mtime_ns,
+                       "size": stat.st_size, "startdate": None if startdate is None else str(pd.Timestamp(startdate)),
+                       "enddate": None if enddate is None else str(pd.Timestamp(enddate)),
+                       "transforms": list(transforms), "index": index}, sort_keys=True)
+
+
+def _disk_filename(key, cache_dir):
+    return os.path.join(cache_dir, "factors", hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+
+def _evict_disk(cache_dir, size):
+    dirname = os.path.join(cache_dir, "factors")
+    files = sorted((os.path.join(dirname, name) for name in os.listdir(dirname)), key=os.path.getmtime)
+    for filename in files[:max(len(files) - size, 0)]:
+        os.remove(filename)
+
+
+def load_all_factors(source="download", startdate=None, enddate=None, transforms=DEFAULT_TRANSFORMS, database=None,
+                     filename=None, index="000001.SH", cache_dir=CACHE_DIR, refresh=False):
+    '''
+    @source: "download" (csmar_factor_free_shares.csv) or "calculated" (index bars of database and factors.csv)
+    @transforms: names of factorRegistry.TERMS added as columns, e.g. ("Rm2","SMB2","HML2","RmPos")
+    @refresh: load from the sources even if the frame is cached
+    :return: pd.DataFrame(), index = date, columns = the factors and the transforms, a copy of the cached frame
+    '''
+    if filename is None:
+        filename = "csmar_factor_free_shares.csv" if source == "download" else "factors.csv"
+    transforms = tuple(transforms)
+    key = _key(source, filename, startdate, enddate, transforms, index if source == "calculated" else None)
+    diskfile = _disk_filename(key, cache_dir)
+
+    if not refresh and key in _memory:
+        _memory.move_to_end(key)
+        return _memory[key].copy()
+    if not refresh and os.path.exists(diskfile):
+        factors = pd.read_pickle(diskfile)
+        # mtime is the last use of the file for the eviction
+        os.utime(diskfile)
+    else:
+        if source == "download":
+            factors = read_download_factors(filename)
+        elif source == "calculated":
+            factors = read_calculated_factors(database, startdate, enddate, filename, index)
+        else:
+            raise ValueError("unknown factor source {}".format(source))
+        factors = factors.sort_index().loc[startdate:enddate]
+        if transforms:
+            from factorRegistry import TERMS
+            factors = factors.assign(**{name: TERMS[name](factors) for name in transforms})
+        os.makedirs(os.path.dirname(diskfile), exist_ok=True)
+        factors.to_pickle(diskfile + ".tmp")
+        os.replace(diskfile + ".tmp", diskfile)
+        _evict_disk(cache_dir, DISK_SIZE)
+
+    _memory[key] = factors
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+    return factors.copy()
+
+
+def clear_factor_cache(disk=False, cache_dir=CACHE_DIR):
+    _memory.clear()
+    if disk and os.path.isdir(os.path.join(cache_dir, "factors")):
+        _evict_disk(cache_dir, 0)
@@ -0,0 +1,329 @@
+'''
+registry of sorts, factors, design terms and models
+
+a Sort ranks one characteristic panel at every date, a Factor is the long-short return of the intersections
+of some sorts (a family), a model is the list of design terms regressed by FamaFrenchTM.regress_batch.
+all the sorts are ranked in one pass over the stacked panels and the stock rows are looked up once per family,
+so a new factor on an existing family costs one more column and a new family one more lookup
+
+    factors = calc_factors(stocks, {"CAP": CAPData, "PB": PBData, "MOM": momentum_panel(stocks, CAPData["date"])},
+                           ["SMB", "HML", "UMD"])
+    res = regress_model(returns, factors, "Carhart")
+'''
+import itertools
+import numpy as np
+import pandas as pd
+
+from calculateThreeFactors import assign_formation, combine_2x3, group_code_table, _membership
+from symbolCodec import SymbolDateCodec
+from sortKernels import get_backend, bucket_codes, group_reduce
+from stageMetrics import timed
+
+
+class Sort(object):
+    '''
+    sort of the stocks on the panel of variable at every date of the panel
+    breakpoints: ascending fractions, e.g. [0.5] or [0.3, 0.7]
+    labels: label of every bucket from the lowest value up, len(breakpoints) + 1 of them
+    positive: only values > 0 are sorted, otherwise only missing values are dropped
+    min_count: dates with less stocks are not sorted
+
+    as sort_size and sort_value, the lowest bucket is the first int(n*b1) stocks, the highest the last
+    int(n*(1-bk)) stocks and a middle bucket the values strictly between the values at its breakpoints
+    '''
+
+    def __init__(self, variable, breakpoints, labels, positive=False, min_count=101):
+        if len(labels) != len(breakpoints) + 1:
+            raise ValueError("{} breakpoints need {} labels, got {}".format(len(breakpoints), len(breakpoints) + 1, labels))
+        self.variable = variable
+        self.breakpoints = list(breakpoints)
+        self.labels = list(labels)
+        self.positive = positive
+        self.min_count = min_count
+
+
+class Factor(object):
+    '''
+    long-short factor on the groups of a family of sorts
+    family: names of the sorts, the groups are the concatenated labels, e.g. ("size", "value") -> "SV"
+    return: (sum of the long groups - sum of the short groups) / len(long)
+    '''
+
+    def __init__(self, family, long, short):
+        self.family = tuple(family)
+        self.long = list(long)
+        self.short = list(short)
+
+
+SORTS = {}
+FACTORS = {}
+TERMS = {}
+MODELS = {}
+
+
+def register_sort(name, sort):
+    SORTS[name] = sort
+
+
+def register_factor(name, factor):
+    for sortname in factor.family:
+        if sortname not in SORTS:
+            raise KeyError("sort {} of factor {} is not registered".format(sortname, name))
+    FACTORS[name] = factor
+
+
+def register_term(name, func):
+    '''
+    func: function of the factor frame (index = date, columns = "Rm" and the factors) returning a pd.Series
+    '''
+    TERMS[name] = func
+
+
+def register_model(name, terms):
+    MODELS[name] = list(terms)
+
+
+register_sort("size", Sort("CAP", [0.5], ["S", "B"]))
+register_sort("value", Sort("PB", [0.3, 0.7], ["V", "N", "G"]))
+register_sort("momentum", Sort("MOM", [0.3, 0.7], ["D", "M", "U"]))
+register_sort("profitability", Sort("ROE", [0.3, 0.7], ["W", "M", "R"]))
+register_sort("investment", Sort("INV", [0.3, 0.7], ["C", "M", "A"]))
+
+register_factor("SMB", Factor(("size", "value"), ["SV", "SN", "SG"], ["BV", "BN", "BG"]))
+register_factor("HML", Factor(("size", "value"), ["SV", "BV"], ["SG", "BG"]))
+register_factor("UMD", Factor(("size", "momentum"), ["SU", "BU"], ["SD", "BD"]))
+register_factor("RMW", Factor(("size", "profitability"), ["SR", "BR"], ["SW", "BW"]))
+register_factor("CMA", Factor(("size", "investment"), ["SC", "BC"], ["SA", "BA"]))
+
+for _name in ["Rm", "SMB", "HML", "UMD", "RMW", "CMA"]:
+    register_term(_name, lambda factors, name=_name: factors[name])
+    register_term(_name + "2", lambda factors, name=_name: factors[name] * factors[name])
+# Henriksson-Merton timing term
+register_term("RmPos", lambda factors: factors["Rm"].clip(lower=0))
+
+register_model("TM", ["Rm", "Rm2", "HML", "HML2", "SMB", "SMB2"])
+register_model("HM", ["Rm", "RmPos", "SMB", "HML"])
+register_model("FF3", ["Rm", "SMB", "HML"])
+register_model("Carhart", ["Rm", "SMB", "HML", "UMD"])
+register_model("FF5", ["Rm", "SMB", "HML", "RMW", "CMA"])
+
+
+@timed(rows=lambda res: sum(len(table) for table in res.values()))
+def sort_panels(panels, sorts):
+    '''
+    rank every sort in one stable sort of the stacked panels
+    panels: {variable: pd.DataFrame(), columns = "date","symbol","value"}
+    sorts: {name: Sort}
+    :return: {name: pd.DataFrame(), columns = "date","symbol","group"}
+    '''
+    names = list(sorts)
+    frames = []
+    for i, name in enumerate(names):
+        sort = sorts[name]
+        data = panels[sort.variable][["date", "symbol", "value"]]
+        data = data[data["value"] > 0] if sort.positive else data.dropna(subset=["value"])
+        frames.append(data.assign(sort=np.int16(i)))
+    data = pd.concat(frames, ignore_index=True).sort_values(["sort", "date", "value"], kind="mergesort")
+    grouped = data.groupby(["sort", "date"], sort=False)
+    pos = grouped.cumcount().to_numpy()
+    num = grouped["value"].transform("size").to_numpy()
+    sortid = data["sort"].to_numpy()
+    value = data["value"].to_numpy()
+
+    tables = {}
+    bounds = np.searchsorted(sortid, np.arange(len(names) + 1))
+    for i, name in enumerate(names):
+        sort = sorts[name]
+        part = slice(bounds[i], bounds[i + 1])
+        keep = num[part] >= sort.min_count
+        rows = data.iloc[part][keep]
+        codes = bucket_codes(pos[part][keep], num[part][keep], value[part][keep], sort.breakpoints)
+        rows = rows[codes >= 0].assign(group=np.array(sort.labels, dtype=object)[codes[codes >= 0]])
+        tables[name] = _membership(rows)
+    return tables
+
+
+def family_membership(family, tables, panels):
+    '''
+    intersect the sorts of a family at every date of their panels after all of them have started, as sort_2x3
+    :return: pd.DataFrame(), columns = "date","symbol","group"
+    '''
+    if len(family) == 1:
+        return tables[family[0]]
+    variables = [SORTS[name].variable for name in family]
+    startdate = max(panels[variable]["date"].min() for variable in variables)
+    datelist = pd.concat([panels[variable]["date"] for variable in variables]).drop_duplicates()
+    datelist = datelist[datelist >= startdate]
+    membership = tables[family[0]]
+    membership = membership[membership["date"] >= startdate]
+    for name in family[1:]:
+        table = tables[name]
+        membership = combine_2x3(membership, table[table["date"] >= startdate], datelist)
+    return membership
+
+
+def calc_family_returns(stockdf, memberships, isweighted, lastPeriod=False):
+    '''
+    daily return of every group of every family, the stock rows are encoded once and looked up once per family
+    stockdf: "date","symbol","return","CAP"
+    memberships: {family: membership table}
+    :return: ({family: pd.DataFrame(), index = date, columns = groups}, pd.Series() "Rm" in the periods of the first family)
+    '''
+    dayIndex, days = pd.factorize(stockdf["date"], sort=True)
+    if isweighted:
+        values = pd.DataFrame({"CAP_return": (stockdf["CAP"] * stockdf["return"]).to_numpy(),
+                               "CAP": stockdf["CAP"].to_numpy()})
+    else:
+        values = pd.DataFrame({"return": stockdf["return"].to_numpy()})
+
+    def group_return(rows, keys):
+        if get_backend() != "pandas":
+            res = group_reduce([keys], values[rows], "sum" if isweighted else "mean")
+            return res["CAP_return"] / res["CAP"] if isweighted else res["return"]
+        if isweighted:
+            group = values[rows].groupby(keys).sum()
+            return group["CAP_return"] / group["CAP"]
+        return values[rows].groupby(keys)["return"].mean()
+
+    codec = SymbolDateCodec()
+    integer = pd.api.types.is_integer_dtype(stockdf["symbol"]) and all(
+        pd.api.types.is_integer_dtype(membership["symbol"]) for membership in memberships.values())
+    if integer:
+        stockIds = stockdf["symbol"].to_numpy()
+    else:
+        for membership in memberships.values():
+            codec.add_symbols(membership["symbol"])
+        stockIds = codec.encode_symbols(stockdf["symbol"])
+    stockIds = np.where(stockIds >= 0, stockIds, -1)
+
+    results, market = {}, None
+    for family, membership in memberships.items():
+        formation = SymbolDateCodec(dates=membership["date"])
+        memberIds = membership["symbol"].to_numpy() if integer else codec.encode_symbols(membership["symbol"])
+        nsymbols = max(memberIds.max(initial=-1), stockIds.max(initial=-1)) + 1
+        table, categories = group_code_table(membership, memberIds, nsymbols, formation)
+        ngroups = len(categories)
+        pos = assign_formation(stockdf, formation.dates, lastPeriod)
+        inperiod = pos >= 0
+        codes = np.full(len(pos), -1, dtype=np.int8)
+        codes[inperiod] = table[pos[inperiod], stockIds[inperiod]]
+
+        ingroup = codes >= 0
+        res = group_return(ingroup, dayIndex[ingroup] * ngroups + codes[ingroup])
+        keys = res.index.to_numpy()
+        res = pd.Series(res.to_numpy(), index=pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex(days[keys // ngroups], name="date"),
+             pd.Categorical.from_codes(keys % ngroups, categories)], names=["date", "group"]))
+        labels = ["".join(p) for p in itertools.product(*[SORTS[name].labels for name in family])]
+        res = res.unstack("group")
+        res.columns = list(res.columns)
+        results[family] = res.reindex(columns=labels)
+        if market is None:
+            market = group_return(inperiod, dayIndex[inperiod])
+            market.index = pd.DatetimeIndex(days[market.index.to_numpy()], name="date")
+            market = market.rename("Rm")
+    return results, market
+
+
+@timed()
+def calc_factors(stockdf, panels, factorNames=("SMB", "HML"), isweighted=True, lastPeriod=False, groups=False):
+    '''
+    stockdf: "date","symbol","return","CAP"
+    panels: {variable: pd.DataFrame(), columns = "date","symbol","value"}, the variables of the sorts of the factors
+    factorNames: registered factors, "Rm" is the market return in the holding periods of the first factor's family
+    lastPeriod: the last sort of every family also holds after its date
+    groups: also return the group returns, columns "<family>:<group>"
+    :return: pd.DataFrame(), index = date, columns = "Rm" and factorNames
+
+    with factorNames ("SMB", "HML") the numbers are the same as calc_factors_2x3_divided(sort_2x3(CAP, PB), stockdf)
+    '''
+    factors = {name: FACTORS[name] for name in factorNames}
+    families = list(dict.fromkeys(factor.family for factor in factors.values()))
+    sortNames = list(dict.fromkeys(name for family in families for name in family))
+    tables = sort_panels(panels, {name: SORTS[name] for name in sortNames})
+    memberships = {family: family_membership(family, tables, panels) for family in families}
+    returns, market = calc_family_returns(stockdf, memberships, isweighted, lastPeriod)
+
+    columns = {}
+    for name, factor in factors.items():
+        res = returns[factor.family]
+        long, short = res[factor.long[0]], res[factor.short[0]]
+        for group in factor.long[1:]:
+            long = long + res[group]
+        for group in factor.short[1:]:
+            short = short + res[group]
+        columns[name] = (long - short) / len(factor.long)
+    result = pd.DataFrame({"Rm": market}).join(pd.DataFrame(columns), how="outer")
+    if groups:
+        frames = [res.add_prefix("/".join(family) + ":") for family, res in returns.items()]
+        result = result.join(frames, how="outer")
+    return result
+
+
+def momentum_panel(stockdf, dates=None, lookback=252, skip=21, min_obs=None):
+    '''
+    past return from lookback to skip trading days before every date, the panel of the "momentum" sort
+    stockdf: "date","symbol","return"
+    dates: dates of the panel, default all the trading days
+    min_obs: minimum number of returns in the window, default half of it
+    :return: pd.DataFrame(), columns = "date","symbol","value"
+    '''
+    if min_obs is None:
+        min_obs = (lookback - skip) // 2
+    returns = stockdf.pivot(index="date", columns="symbol", values="return").sort_index()
+    logs = np.log1p(returns.to_numpy())
+    cumsum = np.vstack([np.zeros((1, logs.shape[1])), np.nancumsum(logs, axis=0)])
+    counts = np.vstack([np.zeros((1, logs.shape[1])), np.cumsum(~np.isnan(logs), axis=0)])
+
+    rows = np.arange(len(returns)) if dates is None else returns.index.get_indexer(pd.DatetimeIndex(pd.unique(dates)))
+    rows = np.sort(rows[rows >= lookback])
+    value = np.exp(cumsum[rows - skip + 1] - cumsum[rows - lookback + 1]) - 1
+    value[counts[rows - skip + 1] - counts[rows - lookback + 1] < min_obs] = np.nan
+    panel = pd.DataFrame(value, index=returns.index[rows], columns=returns.columns).stack().rename("value")
+    return panel.reset_index()[["date", "symbol", "value"]]
+
+
+def design_frame(factors, model):
+    '''
+    :return: pd.DataFrame(), index = date, columns = the terms of the model
+    '''
+    return pd.DataFrame({term: TERMS[term](factors) for term in MODELS[model]})
+
+
+def regress_model(returns, factors, model="TM", normalize=False):
+    '''
+    regress_batch of every fund on the terms of a registered model
+    factors: output of calc_factors, or any frame with the factors the terms use
+    '''
+    from FamaFrenchTM import regress_batch
+
+    return regress_batch(returns, design_frame(factors, model), MODELS[model], normalize)
+
+
+def get_model_factors(stocks_filename, panel_filenames, startdate, enddate, factorNames=("SMB", "HML"),
+                      isweighted=True, weightedBy="free_float_shares", factors_filename="modelfactors.csv"):
+    '''
+    calc_factors on the csv/parquet panels, as get_factors
+    panel_filenames: {variable: filename}, e.g. {"CAP": CAP file, "PB": PB file, "ROE": ROE file}, the files have
+                     the "symbol","date","value" layout of the PB and CAP data;
+                     the "MOM" panel is calculated from the stock returns if it has no file
+    '''
+    from dataCache import read_panel
+
+    codec = SymbolDateCodec()
+    panels = {}
+    for variable, filename in panel_filenames.items():
+        panels[variable] = read_panel(filename, ['symbol', 'date', 'value'], startdate, enddate)
+        panels[variable]["symbol"] = codec.encode_symbols(panels[variable]["symbol"], add=True)
+    stocks = read_panel(stocks_filename, ['date', 'symbol', 'return', weightedBy], startdate, enddate)
+    stocks["CAP"] = stocks[weightedBy]
+    stocks["symbol"] = codec.encode_symbols(stocks["symbol"], add=True)
+
+    variables = {SORTS[name].variable for factor in factorNames for name in FACTORS[factor].family}
+    if "MOM" in variables and "MOM" not in panels:
+        dates = panels["CAP"]["date"] if "CAP" in panels else None
+        panels["MOM"] = momentum_panel(stocks, dates)
+
+    factors = calc_factors(stocks, panels, factorNames, isweighted)
+    factors.to_csv(factors_filename)
+    return factors
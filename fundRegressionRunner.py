@@ -0,0 +1,175 @@
+'''
+run the fund regressions of regression_from_download_factors on all cores
+
+    python fundRegressionRunner.py --sqlite market.sqlite --factors csmar_factor_free_shares.csv --output stockfund_csmar.csv
+    python fundRegressionRunner.py --config ../Config/config2.json --workers 16 --shard-size 100
+
+the funds are split into shards of shard-size funds, every worker process fetches the returns of a shard from its
+own connection, regresses them with regress_batch and writes shard_<n>.parquet into the work directory.
+the factors are written once to factors.npy and memory mapped by the workers instead of pickled with every shard.
+shards whose parquet file exists are skipped, so a crashed run is resumed by running the same command again.
+shards.json records the dates, the hash of the factors file and the shard size; a run with others refuses to
+resume the shards unless --restart is given, which deletes them first.
+'''
+import os
+import json
+import datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from FamaFrenchTM import get_stock_funds, get_fund_returns, regress_batch, save_results
+from factorLoader import load_all_factors
+from dataCache import file_hash
+from stageMetrics import timed, flush
+
+_factors = None
+
+
+def open_database(spec):
+    '''
+    @spec: ("sqlite", filename) or ("config", config filename, database name), picklable for the workers
+    '''
+    if spec[0] == "sqlite":
+        from dataFetcher import SQLiteDatabase
+        return SQLiteDatabase(spec[1])
+    from Core.Config import Config
+    return Config(spec[1]).DataBase(spec[2])
+
+
+def write_shared_factors(factors, workdir):
+    '''
+    write the factors as factors.npy (float64, dates x factors) and factors.json (dates and column names)
+    '''
+    np.save(os.path.join(workdir, "factors.npy"), factors.to_numpy(dtype=float))
+    with open(os.path.join(workdir, "factors.json"), "w") as f:
+        json.dump({"dates": [d.strftime("%Y-%m-%d") for d in factors.index], "columns": list(factors.columns)}, f)
+
+
+def read_shared_factors(workdir):
+    '''
+    :return: pd.DataFrame() on the memory map of factors.npy
+    '''
+    with open(os.path.join(workdir, "factors.json")) as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(workdir, "factors.npy"), mmap_mode="r")
+    return pd.DataFrame(values, index=pd.DatetimeIndex(meta["dates"], name="date"), columns=meta["columns"], copy=False)
+
+
+def _init_worker(workdir):
+    global _factors
+    _factors = read_shared_factors(workdir)
+
+
+def shard_filename(workdir, shard):
+    return os.path.join(workdir, "shard_{:05d}.parquet".format(shard))
+
+
+def run_shard(spec, shard, funds, startdate, enddate, workdir, bulk_size=None):
+    '''
+    regress the funds of one shard and write its parquet file
+    :return: (shard, number of regressed funds)
+    '''
+    database = open_database(spec)
+    returns = get_fund_returns(database, funds, startdate, enddate, max_workers=1, bulk_size=bulk_size)
+    if returns.empty:
+        res = pd.DataFrame(index=pd.Index([], name="fundid", dtype=object))
+    else:
+        res = regress_batch(returns, _factors)
+    # written under a temporary name first, a crash never leaves a partial shard behind
+    filename = shard_filename(workdir, shard)
+    res.to_parquet(filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+    return shard, len(res)
+
+
+def plan_shards(funds_list, shard_size, workdir, params=None, restart=False):
+    '''
+    the shards of a work directory are fixed by its first run, later runs with the same params resume the same shards
+    @params: json serializable dict of the run, e.g. the dates and the hash of the factors file
+    @restart: delete the shards of a run with other params and start again, else refuse to resume them
+    :return: list of lists of fund ids
+    '''
+    params = dict(params or {}, shard_size=shard_size)
+    filename = os.path.join(workdir, "shards.json")
+    if os.path.exists(filename):
+        with open(filename) as f:
+            plan = json.load(f)
+        if isinstance(plan, dict) and plan.get("params") == params:
+            return plan["shards"]
+        if not restart:
+            raise ValueError("{} holds the shards of a run with other params {}, use another work directory or "
+                             "restart".format(workdir, plan.get("params") if isinstance(plan, dict) else None))
+        for name in os.listdir(workdir):
+            if name.startswith("shard_"):
+                os.remove(os.path.join(workdir, name))
+    shards = [funds_list[i:i + shard_size] for i in range(0, len(funds_list), shard_size)]
+    with open(filename, "w") as f:
+        json.dump({"params": params, "shards": shards}, f)
+    return shards
+
+
+@timed()
+def merge_shards(workdir, nshards):
+    '''
+    :return: pd.DataFrame(), index = fundid, the results of all shards in shard order
+    '''
+    results = [pd.read_parquet(shard_filename(workdir, shard)) for shard in range(nshards)]
+    results = [res for res in results if len(res)]
+    if not results:
+        return pd.DataFrame(index=pd.Index([], name="fundid"))
+    return pd.concat(results)
+
+
+def run(spec, factors_filename, startdate, enddate, workdir, output, workers=None, shard_size=200, bulk_size=None,
+        store=None, restart=False):
+    os.makedirs(workdir, exist_ok=True)
+    params = {"startdate": startdate.strftime("%Y-%m-%d"), "enddate": enddate.strftime("%Y-%m-%d"),
+              "factors": file_hash(factors_filename)}
+    shards = plan_shards(get_stock_funds(open_database(spec)), shard_size, workdir, params, restart)
+    write_shared_factors(load_all_factors("download", startdate, enddate, filename=factors_filename), workdir)
+
+    todo = [shard for shard in range(len(shards)) if not os.path.exists(shard_filename(workdir, shard))]
+    print("{} shards, {} done, {} to run".format(len(shards), len(shards) - len(todo), len(todo)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(workdir,)) as executor:
+        futures = [executor.submit(run_shard, spec, shard, shards[shard], startdate, enddate, workdir, bulk_size)
+                   for shard in todo]
+        for future in as_completed(futures):
+            shard, nfunds = future.result()
+            print("shard {} done, {} funds".format(shard, nfunds))
+
+    res = merge_shards(workdir, len(shards))
+    res.to_csv(output)
+    if store is not None:
+        save_results(store, res, "download", startdate, enddate)
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="regress the stock funds on the downloaded factors in parallel")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--sqlite", help="SQLite file written by dataFetcher.write_sqlite_database")
+    source.add_argument("--config", help="config json of Core.Config")
+    parser.add_argument("--database", default="JDMySQL", help="database name in the config")
+    parser.add_argument("--factors", default="csmar_factor_free_shares.csv")
+    parser.add_argument("--start", default="2016-01-01")
+    parser.add_argument("--end", default="2020-11-01")
+    parser.add_argument("--workdir", default="fund_regression_shards")
+    parser.add_argument("--output", default="stockfund_csmar.csv")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, default number of cores")
+    parser.add_argument("--shard-size", type=int, default=200)
+    parser.add_argument("--bulk-size", type=int, default=None)
+    parser.add_argument("--store", default=None, help="SQLite result store the results are also written to")
+    parser.add_argument("--restart", action="store_true",
+                        help="delete the shards of a run with other dates, factors or shard size")
+    args = parser.parse_args()
+
+    spec = ("sqlite", args.sqlite) if args.sqlite else ("config", args.config, args.database)
+    run(spec, args.factors, datetime.datetime.strptime(args.start, "%Y-%m-%d"),
+        datetime.datetime.strptime(args.end, "%Y-%m-%d"), args.workdir, args.output,
+        workers=args.workers, shard_size=args.shard_size, bulk_size=args.bulk_size, store=args.store,
+        restart=args.restart)
+    flush()
@@ -0,0 +1,177 @@
+'''
+portfolio holdings of the sorts on disk, one directory of .npy files read with memory mapping
+
+    dates.npy    datetime64[ns], the formation dates in ascending order
+    offsets.npy  int64, rows of dates[i] are offsets[i]:offsets[i+1]
+    symbols.npy  int32, symbol id of every row, the rows of a date sorted by (group, symbol)
+    groups.npy   int8, group code of every row
+    meta.json    the group labels and the symbol dictionary of the ids
+
+a date is found by binary search on dates.npy and its rows are a slice, so looking up one date or a range of dates
+reads only those rows
+
+    python holdingsStore.py holdings/2x3 --date 2020-01-10 --group SV
+'''
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+
+
+def write_holdings(dirname, membership, symbols=None):
+    '''
+    membership: long table "date","symbol","group" of sort_size, sort_value or sort_2x3
+    symbols: dictionary of int symbol ids, e.g. SymbolDateCodec.symbols, None if the symbols are strings
+    the directory is replaced as a whole
+    '''
+    if pd.api.types.is_integer_dtype(membership["symbol"]):
+        if symbols is None:
+            raise ValueError("the symbol dictionary is needed for int symbol ids")
+        ids = membership["symbol"].to_numpy(dtype=np.int32)
+        symbols = pd.Index(symbols)
+    else:
+        ids, symbols = pd.factorize(membership["symbol"], sort=True)
+        ids = ids.astype(np.int32)
+        symbols = pd.Index(symbols)
+    groupCodes, labels = pd.factorize(membership["group"].astype(str), sort=True)
+    dates = membership["date"].to_numpy(dtype="datetime64[ns]")
+
+    order = np.lexsort((ids, groupCodes, dates))
+    dates = dates[order]
+    starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if len(dates) else np.array([], dtype=np.int64)
+
+    tmp = dirname + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "dates.npy"), dates[starts])
+    np.save(os.path.join(tmp, "offsets.npy"), np.append(starts, len(dates)).astype(np.int64))
+    np.save(os.path.join(tmp, "symbols.npy"), ids[order])
+    np.save(os.path.join(tmp, "groups.npy"), groupCodes[order].astype(np.int8))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"format": FORMAT_VERSION, "groups": list(labels), "symbols": [str(s) for s in symbols]}, f)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp, dirname)
+
+
+class HoldingsStore(object):
+    '''
+    the holdings written by write_holdings, the arrays are memory mapped
+    '''
+
+    def __init__(self, dirname, mmap=True):
+        mode = "r" if mmap else None
+        with open(os.path.join(dirname, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format"] != FORMAT_VERSION:
+            raise ValueError("{} has format {}, not {}".format(dirname, meta["format"], FORMAT_VERSION))
+        self.dirname = dirname
+        self.groups = meta["groups"]
+        self.symbols = pd.Index(meta["symbols"], dtype=object)
+        self.dates = np.load(os.path.join(dirname, "dates.npy"), mmap_mode=mode)
+        self.offsets = np.load(os.path.join(dirname, "offsets.npy"), mmap_mode=mode)
+        self.symbolIds = np.load(os.path.join(dirname, "symbols.npy"), mmap_mode=mode)
+        self.groupCodes = np.load(os.path.join(dirname, "groups.npy"), mmap_mode=mode)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _position(self, date, asof=True):
+        '''
+        :return: position of date in dates, or of the latest date on or before it if asof, -1 if none
+        '''
+        date = np.datetime64(pd.Timestamp(date), "ns")
+        i = np.searchsorted(self.dates, date, side="right") - 1
+        if i < 0 or (not asof and self.dates[i] != date):
+            return -1
+        return int(i)
+
+    def formation_date(self, date):
+        '''
+        :return: the latest formation date on or before date, whose holdings are held on date, None if none
+        '''
+        i = self._position(date)
+        return None if i < 0 else pd.Timestamp(self.dates[i])
+
+    def _frame(self, lo, hi, codec=None):
+        rows = slice(self.offsets[lo], self.offsets[hi])
+        ids = np.asarray(self.symbolIds[rows])
+        if codec is None:
+            symbol = pd.Categorical.from_codes(ids, self.symbols)
+        else:
+            symbol = codec.encode_symbols(self.symbols, add=True)[ids]
+        return pd.DataFrame({"date": np.repeat(np.asarray(self.dates[lo:hi]), np.diff(self.offsets[lo:hi + 1])),
+                             "symbol": symbol,
+                             "group": pd.Categorical.from_codes(np.asarray(self.groupCodes[rows]), self.groups)})
+
+    def holdings(self, date, asof=True, codec=None):
+        '''
+        asof: the holdings of the latest formation date on or before date, else only of date itself
+        codec: a SymbolDateCodec to return its int ids, else the symbols are categorical strings
+        :return: pd.DataFrame(), columns = "date","symbol","group", empty if there are none
+        '''
+        i = self._position(date, asof)
+        if i < 0:
+            return self._frame(0, 0, codec)
+        return self._frame(i, i + 1, codec)
+
+    def members(self, date, group, asof=True):
+        '''
+        :return: np.array of the symbols in group on date
+        '''
+        i = self._position(date, asof)
+        if i < 0 or group not in self.groups:
+            return np.array([], dtype=object)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        codes = np.asarray(self.groupCodes[lo:hi])
+        code = self.groups.index(group)
+        # the rows of a date are sorted by group
+        a, b = np.searchsorted(codes, [code, code + 1])
+        return self.symbols.to_numpy()[np.asarray(self.symbolIds[lo + a:lo + b])]
+
+    def range(self, startdate=None, enddate=None, codec=None):
+        '''
+        :return: the membership table of the formation dates between startdate and enddate, both included
+        '''
+        lo = 0 if startdate is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(startdate), "ns"))
+        hi = len(self.dates) if enddate is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(enddate),
+                                                                                                "ns"), side="right")
+        return self._frame(lo, max(lo, hi), codec)
+
+    def to_membership(self, codec=None):
+        '''
+        the whole membership table, as calc_group_returns takes it
+        '''
+        return self._frame(0, len(self.dates), codec)
+
+    def counts(self, startdate=None, enddate=None):
+        '''
+        :return: pd.DataFrame(), index = formation date, columns = groups, number of stocks
+        '''
+        table = self.range(startdate, enddate)
+        return table.groupby(["date", "group"], observed=False).size().unstack("group")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="show the holdings of a sort on a date")
+    parser.add_argument("dirname")
+    parser.add_argument("--date", default=None, help="the holdings held on this date")
+    parser.add_argument("--group", default=None)
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    args = parser.parse_args()
+
+    store = HoldingsStore(args.dirname)
+    if args.date is None:
+        print(store.counts(args.start, args.end).to_string())
+    elif args.group is not None:
+        print("formed on", store.formation_date(args.date))
+        print("\n".join(store.members(args.date, args.group)))
+    else:
+        print("formed on", store.formation_date(args.date))
+        print(store.holdings(args.date).groupby("group", observed=False).size().to_string())
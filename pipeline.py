@@ -0,0 +1,363 @@
+'''
+the get_stock_data -> get_factors -> regression flow as a DAG of stages with content-hashed artifacts
+
+a stage declares its input and output files, the stages producing its inputs are its dependencies and
+independent stages run concurrently (the fund NAV fetch runs alongside the factor construction).
+the key of a stage is the hash of its function, the code version (git HEAD and the hash of any uncommitted diff,
+else the sha1 of the module source of the function), its params and the sha1 of its input files; a stage whose key
+and outputs are unchanged since the last run is skipped. outputs are copied into <workdir>/artifacts/<sha1>
+and every run writes a manifest (<workdir>/runs/<run id>.json) with the keys, params, input and output hashes,
+code version and timings; reproduce(manifest) puts the outputs of any run back from the artifacts.
+
+stages reading the database are keyed by their params only, the database has no content hash:
+pass force=[stage names] to run them again
+
+    python pipeline.py --config ../Config/config2.json --start 2016-01-01 --end 2020-11-01 \
+        --pb PB_data20160101to20201101.csv --cap CAP_data20160101to20201101.csv
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import inspect
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from dataCache import file_hash
+from breakpointEngine import get_mode, metadata_filename
+
+
+class Stage(object):
+    '''
+    func(**params, **context) writes the outputs
+    inputs, outputs: file names, relative to the working directory
+    params: hashed into the key, json serializable (dates are hashed as str)
+    context: passed to func but not hashed, e.g. the database connection pool
+    '''
+
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, context=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.context = context or {}
+
+
+def _git(*args):
+    try:
+        out = subprocess.run(["git"] + list(args), cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout if out.returncode == 0 else None
+
+
+def _code_version():
+    '''
+    :return: git HEAD, followed by "+dirty." and the hash of the diff if there are uncommitted changes, None without git
+    '''
+    head = _git("rev-parse", "HEAD")
+    if not head:
+        return None
+    diff = _git("diff", "HEAD")
+    if diff:
+        return "{}+dirty.{}".format(head.strip(), hashlib.sha1(diff.encode()).hexdigest()[:12])
+    return head.strip()
+
+
+def _source_hash(func):
+    '''
+    sha1 of the source file of the module of func, the code version of a stage outside a git checkout
+    '''
+    try:
+        return file_hash(inspect.getsourcefile(func))
+    except (TypeError, OSError):
+        return None
+
+
+class Pipeline(object):
+
+    def __init__(self, stages, workdir=".pipeline", max_workers=4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.workdir = workdir
+        self.max_workers = max_workers
+        self.code_version = _code_version()
+        producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError("{} is an output of both {} and {}".format(output, producers[output], stage.name))
+                producers[output] = stage.name
+        self.dependencies = {stage.name: sorted({producers[i] for i in stage.inputs if i in producers})
+                             for stage in stages}
+        self._check_cycles()
+
+    def _check_cycles(self):
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("cycle in the pipeline: {}".format(" -> ".join(path + [name])))
+            state[name] = "visiting"
+            for dep in self.dependencies[name]:
+                visit(dep, path + [name])
+            state[name] = "done"
+
+        for name in self.stages:
+            visit(name, [])
+
+    def _manifest_filename(self):
+        return os.path.join(self.workdir, "manifest.json")
+
+    def _artifact(self, sha1):
+        return os.path.join(self.workdir, "artifacts", sha1)
+
+    def _load_manifest(self):
+        if not os.path.exists(self._manifest_filename()):
+            return {"stages": {}}
+        with open(self._manifest_filename()) as f:
+            return json.load(f)
+
+    def _key(self, stage, inputs):
+        func = "{}.{}".format(getattr(stage.func, "__module__", ""), getattr(stage.func, "__qualname__", stage.func))
+        code = self.code_version or _source_hash(stage.func)
+        content = json.dumps({"stage": stage.name, "func": func, "code": code, "params": stage.params,
+                              "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _store(self, filename):
+        sha1 = file_hash(filename)
+        artifact = self._artifact(sha1)
+        if not os.path.exists(artifact):
+            shutil.copyfile(filename, artifact + ".tmp")
+            os.replace(artifact + ".tmp", artifact)
+        return sha1
+
+    def _up_to_date(self, previous, key):
+        '''
+        the outputs of the previous run of the stage are in place, or are put back from the artifacts
+        '''
+        if previous is None or previous.get("key") != key or previous.get("status") not in ("done", "skipped"):
+            return False
+        for output, sha1 in previous["outputs"].items():
+            if os.path.exists(output) and file_hash(output) == sha1:
+                continue
+            if not os.path.exists(self._artifact(sha1)):
+                return False
+            shutil.copyfile(self._artifact(sha1), output)
+        return True
+
+    def _run_stage_sync(self, stage, previous, force):
+        inputs = {}
+        for filename in stage.inputs:
+            if not os.path.exists(filename):
+                raise FileNotFoundError("input {} of stage {} does not exist".format(filename, stage.name))
+            inputs[filename] = file_hash(filename)
+        key = self._key(stage, inputs)
+        record = {"key": key, "params": stage.params, "inputs": inputs, "started": datetime.datetime.now().isoformat()}
+        start = time.perf_counter()
+        if stage.name not in force and self._up_to_date(previous, key):
+            record.update(status="skipped", outputs=previous["outputs"])
+        else:
+            stage.func(**dict(stage.params, **stage.context))
+            missing = [output for output in stage.outputs if not os.path.exists(output)]
+            if missing:
+                raise FileNotFoundError("stage {} did not write {}".format(stage.name, missing))
+            record.update(status="done", outputs={output: self._store(output) for output in stage.outputs})
+        record["seconds"] = time.perf_counter() - start
+        return record
+
+    async def run_async(self, force=()):
+        os.makedirs(os.path.join(self.workdir, "artifacts"), exist_ok=True)
+        os.makedirs(os.path.join(self.workdir, "runs"), exist_ok=True)
+        previous = self._load_manifest()["stages"]
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        records = {}
+        tasks = {}
+
+        async def run(name):
+            await asyncio.gather(*[tasks[dep] for dep in self.dependencies[name]])
+            try:
+                records[name] = await loop.run_in_executor(executor, self._run_stage_sync, self.stages[name],
+                                                           previous.get(name), set(force))
+            except Exception as e:
+                records[name] = {"status": "failed", "error": repr(e)}
+                raise
+            print("{}: {} ({:.1f}s)".format(name, records[name]["status"], records[name]["seconds"]))
+
+        for name in self.stages:
+            tasks[name] = asyncio.ensure_future(run(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            executor.shutdown(wait=True)
+            self._write_manifest(previous, records)
+        return records
+
+    def run(self, force=()):
+        '''
+        force: names of the stages run even if they are up to date
+        :return: {stage name: record of the manifest}
+        '''
+        return asyncio.run(self.run_async(force))
+
+    def _write_manifest(self, previous, records):
+        import numpy as np
+        import pandas as pd
+
+        stages = dict(previous)
+        stages.update(records)
+        run_id = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        manifest = {"run_id": run_id, "workdir": os.path.abspath(self.workdir), "cwd": os.getcwd(),
+                    "code_version": self.code_version, "python": sys.version.split()[0],
+                    "pandas": pd.__version__, "numpy": np.__version__,
+                    "dependencies": self.dependencies, "stages": stages}
+        with open(os.path.join(self.workdir, "runs", run_id + ".json"), "w") as f:
+            json.dump(manifest, f, indent=1, default=str)
+        with open(self._manifest_filename() + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, default=str)
+        os.replace(self._manifest_filename() + ".tmp", self._manifest_filename())
+
+
+def reproduce(manifest_filename, stages=None, dirname=None):
+    '''
+    put the outputs of a run back from the artifacts
+    stages: names of the stages, default all
+    dirname: directory of the outputs, default the working directory of the run
+    :return: {output file: sha1}
+    '''
+    with open(manifest_filename) as f:
+        manifest = json.load(f)
+    dirname = manifest["cwd"] if dirname is None else dirname
+    restored = {}
+    for name, record in manifest["stages"].items():
+        if stages is not None and name not in stages:
+            continue
+        for output, sha1 in record.get("outputs", {}).items():
+            filename = os.path.join(dirname, output)
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            shutil.copyfile(os.path.join(manifest["workdir"], "artifacts", sha1), filename)
+            restored[filename] = sha1
+    return restored
+
+
+def _period(startdate, enddate):
+    return "{}to{}".format(startdate.strftime("%Y%m%d"), enddate.strftime("%Y%m%d"))
+
+
+def stock_data_stage(startdate, enddate, output, database):
+    from calculateThreeFactors import get_stock_data
+    get_stock_data(database, startdate, enddate, file_name=output)
+
+
+def factors_stage(stocks_filename, PBdata_filename, CAPdata_filename, startdate, enddate, isweighted,
+                  isSimpleDivided, breakpoints, holdings_dir, output):
+    from calculateThreeFactors import get_factors
+    from breakpointEngine import use_mode
+
+    with use_mode(breakpoints):
+        get_factors(stocks_filename, PBdata_filename, CAPdata_filename, startdate, enddate, isweighted=isweighted,
+                    isSimpleDivided=isSimpleDivided, factors_filename=output, holdings_dir=holdings_dir)
+
+
+def fund_returns_stage(startdate, enddate, output, database):
+    from FamaFrenchTM import get_fund_returns, get_stock_funds
+    returns = get_fund_returns(database, get_stock_funds(database), startdate, enddate)
+    returns.index.name = "date"
+    returns.to_csv(output)
+
+
+def regression_stage(factors_filename, returns_filename, startdate, enddate, transforms, output, database):
+    import pandas as pd
+    from FamaFrenchTM import regress_batch
+    from factorLoader import read_calculated_factors
+    from factorRegistry import TERMS
+
+    factors = read_calculated_factors(database, startdate, enddate, factors_filename, date_format="%Y-%m-%d")
+    factors = factors.assign(**{name: TERMS[name](factors) for name in transforms})
+    returns = pd.read_csv(returns_filename, index_col="date", parse_dates=["date"])
+    regress_batch(returns, factors).to_csv(output)
+
+
+def build_pipeline(database, startdate, enddate, PBdata_filename, CAPdata_filename, isweighted=True,
+                   isSimpleDivided=True, outdir=".", workdir=".pipeline", transforms=("Rm2", "SMB2", "HML2")):
+    '''
+    stock_data -> factors -> regression, with fund_returns alongside factors
+    outputs in outdir: stock_data<period>.csv, factors<period>.csv, fund_returns<period>.csv, fund_all<period>.csv
+    the factors are built with the breakpoint mode set in breakpointEngine, the sorts are saved in holdings<period>
+    '''
+    period = _period(startdate, enddate)
+    stocks, factors, returns, result = [os.path.join(outdir, "{}{}.csv".format(name, period))
+                                        for name in ("stock_data", "factors", "fund_returns", "fund_all")]
+    os.makedirs(outdir, exist_ok=True)
+    dates = {"startdate": startdate, "enddate": enddate}
+    context = {"database": database}
+    stages = [
+        Stage("stock_data", stock_data_stage, outputs=[stocks], params=dict(dates, output=stocks), context=context),
+        Stage("factors", factors_stage, inputs=[stocks, PBdata_filename, CAPdata_filename],
+              outputs=[factors, metadata_filename(factors)],
+              params=dict(dates, stocks_filename=stocks, PBdata_filename=PBdata_filename,
+                          CAPdata_filename=CAPdata_filename, isweighted=isweighted, isSimpleDivided=isSimpleDivided,
+                          breakpoints=get_mode(),
+                          holdings_dir=os.path.join(outdir, "holdings{}".format(period)), output=factors)),
+        Stage("fund_returns", fund_returns_stage, outputs=[returns], params=dict(dates, output=returns),
+              context=context),
+        Stage("regression", regression_stage, inputs=[factors, returns], outputs=[result],
+              params=dict(dates, factors_filename=factors, returns_filename=returns, transforms=list(transforms),
+                          output=result),
+              context=context),
+    ]
+    return Pipeline(stages, workdir)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="run the factor and regression pipeline")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--sqlite", help="SQLite file written by dataFetcher.write_sqlite_database")
+    source.add_argument("--config", help="config json of Core.Config")
+    parser.add_argument("--database", default="JDMySQL", help="database name in the config")
+    parser.add_argument("--start", required=True)
+    parser.add_argument("--end", required=True)
+    parser.add_argument("--pb", required=True, help="PB data file")
+    parser.add_argument("--cap", required=True, help="CAP data file")
+    parser.add_argument("--equal-weighted", action="store_true")
+    parser.add_argument("--2x3", dest="twobythree", action="store_true", help="the 2x3 sort of Fama-French(1993)")
+    parser.add_argument("--breakpoints", default=None, help="breakpoint mode: sort or partition")
+    parser.add_argument("--force", nargs="*", default=[], help="stages to run even if up to date")
+    parser.add_argument("--outdir", default=".")
+    parser.add_argument("--workdir", default=".pipeline")
+    parser.add_argument("--reproduce", default=None, help="manifest of a run to put back instead of running")
+    args = parser.parse_args()
+
+    if args.reproduce:
+        for filename, sha1 in reproduce(args.reproduce).items():
+            print(filename, sha1)
+        sys.exit(0)
+
+    if args.breakpoints:
+        from breakpointEngine import set_mode
+        set_mode(args.breakpoints)
+    from dataFetcher import ConnectionPool, SQLiteDatabase
+    if args.sqlite:
+        pool = ConnectionPool(lambda: SQLiteDatabase(args.sqlite), size=8)
+    else:
+        from Core.Config import Config
+        config = Config(args.config)
+        pool = ConnectionPool(lambda: config.DataBase(args.database), size=8)
+    startdate = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    enddate = datetime.datetime.strptime(args.end, "%Y-%m-%d")
+    build_pipeline(pool, startdate, enddate, args.pb, args.cap, isweighted=not args.equal_weighted,
+                   isSimpleDivided=not args.twobythree, outdir=args.outdir,
+                   workdir=args.workdir).run(force=args.force)
@@ -0,0 +1,234 @@
+'''
+regression results of every run in one SQLite file, one row per (run, fund, model, window, term)
+
+    runs(run_id, created, model, factors, params), one row per (run, model)
+    coefficients(run_id, fundid, model, window, term, estimate, tvalue, pvalue, nobs)
+
+window is "all" for a regression on the whole sample (regress_batch) and the last date of the window for
+rolling_regress. the coefficients are indexed by (model, term, window, run_id, tvalue) and by (fundid, term),
+so a ranking of one term or the history of one fund reads only its rows
+
+    store = ResultStore("results.sqlite")
+    run_id = store.write(regress_batch(returns, factors), model="TM", params={"source": "download"})
+    store.top_funds("Rm2", model="TM", n=20)
+'''
+import json
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT, created TEXT, model TEXT, factors TEXT, params TEXT,
+    PRIMARY KEY (run_id, model));
+CREATE TABLE IF NOT EXISTS coefficients (
+    run_id TEXT, fundid TEXT, model TEXT, window TEXT, term TEXT,
+    estimate REAL, tvalue REAL, pvalue REAL, nobs REAL,
+    PRIMARY KEY (run_id, fundid, model, window, term));
+CREATE INDEX IF NOT EXISTS coefficient_rank ON coefficients (model, term, window, run_id, tvalue);
+CREATE INDEX IF NOT EXISTS coefficient_fund ON coefficients (fundid, term);
+"""
+
+FULL_SAMPLE = "all"
+
+
+def model_name(factorNames):
+    '''
+    :return: the name of the model of factorRegistry.MODELS with these terms, else the terms joined by "+"
+    '''
+    from factorRegistry import MODELS
+
+    for name, terms in MODELS.items():
+        if list(terms) == list(factorNames):
+            return name
+    return "+".join(factorNames)
+
+
+def _terms(results):
+    return [c for c in results.columns if c + "_t" in results.columns and c + "_p" in results.columns]
+
+
+def to_long(results):
+    '''
+    regress_batch (index = fundid) or rolling_regress (index = date, fundid) results to one row per term
+    :return: pd.DataFrame(), columns = "fundid","window","term","estimate","tvalue","pvalue","nobs"
+    '''
+    terms = _terms(results)
+    if isinstance(results.index, pd.MultiIndex):
+        window = pd.DatetimeIndex(results.index.get_level_values("date")).strftime("%Y-%m-%d").to_numpy()
+        fundids = results.index.get_level_values("fundid").astype(str).to_numpy()
+    else:
+        window = np.full(len(results), FULL_SAMPLE, dtype=object)
+        fundids = results.index.astype(str).to_numpy()
+    nobs = results["nobs"].to_numpy(dtype=float) if "nobs" in results.columns else np.full(len(results), np.nan)
+    k = len(terms)
+    return pd.DataFrame({"fundid": np.repeat(fundids, k), "window": np.repeat(window, k),
+                         "term": np.tile(terms, len(results)),
+                         "estimate": results[terms].to_numpy(dtype=float).ravel(),
+                         "tvalue": results[[t + "_t" for t in terms]].to_numpy(dtype=float).ravel(),
+                         "pvalue": results[[t + "_p" for t in terms]].to_numpy(dtype=float).ravel(),
+                         "nobs": np.repeat(nobs, k)})
+
+
+def _none(value):
+    # NaN is stored as NULL, so it is never ranked first
+    return None if value != value else value
+
+
+class ResultStore(object):
+
+    def __init__(self, filename="results.sqlite"):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+        self.conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    def _migrate(self):
+        '''
+        version 0 keyed runs by run_id alone, its rows are copied into the table keyed by (run_id, model)
+        '''
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'runs'").fetchone()
+        if version >= SCHEMA_VERSION or exists is None:
+            return
+        with self.conn:
+            self.conn.execute("ALTER TABLE runs RENAME TO runs_v0")
+            self.conn.executescript(SCHEMA)
+            self.conn.execute("INSERT INTO runs SELECT run_id, created, model, factors, params FROM runs_v0")
+            self.conn.execute("DROP TABLE runs_v0")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, results, model=None, run_id=None, params=None):
+        '''
+        @results: output of regress_batch or rolling_regress
+        @model: name of the model, default the name of its terms in factorRegistry.MODELS
+        @run_id: default the time of the write; the rows of an existing run_id and model are replaced
+        @params: json serializable dict saved with the run, e.g. the source and the dates of the factors
+        :return: run_id
+        '''
+        terms = [term for term in _terms(results) if term != "const"]
+        model = model_name(terms) if model is None else model
+        run_id = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f") if run_id is None else run_id
+        rows = to_long(results)
+        values = zip([run_id] * len(rows), rows["fundid"], [model] * len(rows), rows["window"], rows["term"],
+                     map(_none, rows["estimate"].tolist()), map(_none, rows["tvalue"].tolist()),
+                     map(_none, rows["pvalue"].tolist()), map(_none, rows["nobs"].tolist()))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                              (run_id, datetime.datetime.now().isoformat(), model, json.dumps(terms),
+                               json.dumps(params or {}, default=str)))
+            self.conn.execute("DELETE FROM coefficients WHERE run_id = ? AND model = ?", (run_id, model))
+            self.conn.executemany("INSERT INTO coefficients VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
+        return run_id
+
+    def runs(self, model=None):
+        '''
+        :return: pd.DataFrame(), one row per run, the latest first
+        '''
+        sql = "SELECT * FROM runs" + (" WHERE model = ?" if model is not None else "") + " ORDER BY created DESC"
+        runs = pd.read_sql_query(sql, self.conn, params=[model] if model is not None else [])
+        runs["factors"] = runs["factors"].map(json.loads)
+        runs["params"] = runs["params"].map(json.loads)
+        return runs
+
+    def latest_run(self, model, window=None):
+        '''
+        :return: the run_id of the latest run of model, with results for window if given, None if there is none
+        '''
+        sql = "SELECT run_id FROM runs WHERE model = ?"
+        params = [model]
+        if window is not None:
+            sql += (" AND EXISTS (SELECT 1 FROM coefficients WHERE coefficients.run_id = runs.run_id "
+                    "AND coefficients.model = runs.model AND coefficients.window = ?)")
+            params.append(window)
+        row = self.conn.execute(sql + " ORDER BY created DESC LIMIT 1", params).fetchone()
+        return None if row is None else row[0]
+
+    def query(self, run_id=None, model=None, fundids=None, terms=None, window=None, startdate=None, enddate=None,
+              wide=False):
+        '''
+        the coefficients matching all the given filters, read with the indexes
+        @run_id, model, window: str or list
+        @fundids, terms: list
+        @startdate, enddate: range of the rolling windows by their last date
+        @wide: one row per (run_id, model, window, fundid) with the columns of regress_batch
+        :return: pd.DataFrame(), columns = "run_id","fundid","model","window","term","estimate","tvalue","pvalue","nobs"
+        '''
+        conditions, params = [], []
+        for column, value in [("run_id", run_id), ("model", model), ("window", window), ("fundid", fundids),
+                              ("term", terms)]:
+            if value is None:
+                continue
+            values = [value] if isinstance(value, str) else list(value)
+            conditions.append("{} IN ({})".format(column, ",".join("?" * len(values))))
+            params += values
+        if startdate is not None or enddate is not None:
+            conditions.append("window != ?")
+            params.append(FULL_SAMPLE)
+        if startdate is not None:
+            conditions.append("window >= ?")
+            params.append(pd.Timestamp(startdate).strftime("%Y-%m-%d"))
+        if enddate is not None:
+            conditions.append("window <= ?")
+            params.append(pd.Timestamp(enddate).strftime("%Y-%m-%d"))
+        sql = "SELECT * FROM coefficients"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        res = pd.read_sql_query(sql, self.conn, params=params)
+        if not wide:
+            return res
+        res = res.set_index(["run_id", "model", "window", "fundid", "term"])
+        nobs = res["nobs"].groupby(level=["run_id", "model", "window", "fundid"]).first()
+        res = res[["estimate", "tvalue", "pvalue"]].unstack("term")
+        res.columns = [term + {"estimate": "", "tvalue": "_t", "pvalue": "_p"}[stat] for stat, term in res.columns]
+        return res.assign(nobs=nobs)
+
+    def top_funds(self, term="Rm2", model="TM", run_id=None, window=FULL_SAMPLE, n=20, by="tvalue", ascending=False):
+        '''
+        the funds ranked by the t-value (or "estimate", "pvalue") of a term, e.g. the best market timers of TM
+        @run_id: default the latest run of model with results for window
+        :return: pd.DataFrame(), n rows, columns of query()
+        '''
+        if by not in ("estimate", "tvalue", "pvalue"):
+            raise ValueError("rank by estimate, tvalue or pvalue, not {}".format(by))
+        run_id = self.latest_run(model, window) if run_id is None else run_id
+        sql = ("SELECT * FROM coefficients WHERE model = ? AND term = ? AND window = ? AND run_id = ? "
+               "AND {by} IS NOT NULL ORDER BY {by} {order} LIMIT ?").format(by=by, order="ASC" if ascending else "DESC")
+        return pd.read_sql_query(sql, self.conn, params=[model, term, window, run_id, n])
+
+    def compare_runs(self, term="Rm2", model="TM", run_ids=None, window=FULL_SAMPLE, value="tvalue"):
+        '''
+        :return: pd.DataFrame(), index = fundid, columns = run ids, value of term in every run
+        '''
+        res = self.query(run_id=run_ids, model=model, terms=[term], window=window)
+        return res.pivot(index="fundid", columns="run_id", values=value)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="query the regression result store")
+    parser.add_argument("filename")
+    parser.add_argument("--runs", action="store_true", help="list the runs")
+    parser.add_argument("--term", default="Rm2")
+    parser.add_argument("--model", default="TM")
+    parser.add_argument("--run-id", default=None)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    with ResultStore(args.filename) as store:
+        if args.runs:
+            print(store.runs().to_string())
+        else:
+            print(store.top_funds(args.term, args.model, args.run_id, n=args.top).to_string())
@@ -0,0 +1,256 @@
+'''
+kernels of the portfolio sorts and the group returns on contiguous per-date arrays
+
+backends:
+    "pandas": the groupby/sort_values code of calculateThreeFactors, the default
+    "numpy": vectorized NumPy, no compiled dependency
+    "numba": compiled loops, needs numba
+
+all the backends give the same numbers bit for bit: the rows are sorted stably by (date, value) like
+sort_values and the group sums are Kahan compensated in row order like the cython groupby sum of pandas.
+the backend is chosen with set_backend(), use_backend() or the environment variable FFTM_KERNELS
+'''
+import os
+import contextlib
+import numpy as np
+import pandas as pd
+
+BACKENDS = ("pandas", "numpy", "numba")
+
+_backend = os.environ.get("FFTM_KERNELS", "pandas")
+_numba = None
+
+
+def set_backend(name):
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("unknown kernel backend {}, use one of {}".format(name, BACKENDS))
+    if name == "numba":
+        _numba_kernels()
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+@contextlib.contextmanager
+def use_backend(name):
+    previous = _backend
+    set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+
+def _numba_kernels():
+    '''
+    compile the numba kernels on first use
+    '''
+    global _numba
+    if _numba is not None:
+        return _numba
+    import numba
+
+    @numba.njit(cache=True)
+    def bucket(starts, values, low, high, min_count, codes):
+        nbp = len(low)
+        for s in range(len(starts) - 1):
+            a, b = starts[s], starts[s + 1]
+            n = b - a
+            if n < min_count:
+                continue
+            lows = np.empty(nbp, dtype=np.int64)
+            highs = np.empty(nbp, dtype=np.int64)
+            for j in range(nbp):
+                lows[j] = int(n * low[j])
+                highs[j] = n - int(n * high[j])
+            for j in range(1, nbp):
+                p1 = values[a + max(lows[j - 1], 1) - 1]
+                p2 = values[min(a + highs[j], b - 1)]
+                for i in range(a, b):
+                    if values[i] > p1 and values[i] < p2:
+                        codes[i] = j
+            for i in range(a, b):
+                if i - a < lows[0]:
+                    codes[i] = 0
+                if i - a >= highs[nbp - 1]:
+                    codes[i] = nbp
+
+    @numba.njit(cache=True)
+    def group_sum(labels, values, ngroups):
+        K = values.shape[1]
+        sums = np.zeros((ngroups, K))
+        compensation = np.zeros((ngroups, K))
+        nobs = np.zeros((ngroups, K), dtype=np.int64)
+        counts = np.zeros(ngroups, dtype=np.int64)
+        for i in range(len(labels)):
+            lab = labels[i]
+            if lab < 0:
+                continue
+            counts[lab] += 1
+            for j in range(K):
+                val = values[i, j]
+                if val == val:
+                    nobs[lab, j] += 1
+                    y = val - compensation[lab, j]
+                    t = sums[lab, j] + y
+                    compensation[lab, j] = t - sums[lab, j] - y
+                    if compensation[lab, j] != compensation[lab, j]:
+                        compensation[lab, j] = 0.0
+                    sums[lab, j] = t
+        return sums, nobs, counts
+
+    @numba.njit(cache=True)
+    def sort_segments(order, starts, values):
+        for s in range(len(starts) - 1):
+            a, b = starts[s], starts[s + 1]
+            rows = order[a:b].copy()
+            order[a:b] = rows[np.argsort(values[rows], kind="mergesort")]
+
+    _numba = {"bucket": bucket, "group_sum": group_sum, "sort_segments": sort_segments}
+    return _numba
+
+
+def _top_fractions(breakpoints):
+    # 1 - 0.7 is 0.30000000000000004, rounded so int(n * 0.3) is the same as sort_value
+    return np.array([round(1 - b, 10) for b in breakpoints])
+
+
+def bucket_codes(pos, num, values, breakpoints):
+    '''
+    bucket of every row of a panel sorted by (date, value), NumPy version
+    pos: position of the row in its date, num: rows of its date
+    breakpoints: ascending fractions, the lowest bucket is the first int(n*b1) rows, the highest the last
+                 int(n*(1-bk)) rows and a middle bucket the values strictly between the values at its breakpoints
+    :return: np.array of int8, -1 if the row is in no bucket
+    '''
+    start = np.arange(len(pos)) - pos
+    low = [(num * b).astype(int) for b in breakpoints]
+    high = [num - (num * top).astype(int) for top in _top_fractions(breakpoints)]
+    codes = np.full(len(pos), -1, dtype=np.int8)
+    for j in range(1, len(breakpoints)):
+        above = values > values[start + np.maximum(low[j - 1], 1) - 1]
+        below = values < values[np.minimum(start + high[j], start + num - 1)]
+        codes[above & below] = j
+    codes[pos < low[0]] = 0
+    codes[pos >= high[-1]] = len(breakpoints)
+    return codes
+
+
+def sort_buckets(dates, values, breakpoints, min_count=0):
+    '''
+    sort the rows stably by (date, value) and bucket every date with the breakpoints
+    dates: array of the dates (or any sortable date codes), values: float array without NaN
+    :return: (order, codes), the sorted positions of the rows and the bucket of each sorted row,
+             -1 for rows in no bucket and the rows of dates with less than min_count rows
+    '''
+    values = np.asarray(values, dtype=float)
+    days = pd.factorize(np.asarray(dates), sort=True)[0]
+    if _backend == "numba":
+        # stable sort by date, linear if the panel is already in date order, then each date by value
+        order = np.argsort(days, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(days[order]) != 0, True]) if len(order) else np.array([0])
+        _numba_kernels()["sort_segments"](order, starts, values)
+    else:
+        order = np.lexsort((values, days))
+        starts = np.flatnonzero(np.r_[True, np.diff(days[order]) != 0, True]) if len(order) else np.array([0])
+    sortedValues = values[order]
+
+    if _backend == "numba":
+        codes = np.full(len(order), -1, dtype=np.int8)
+        _numba_kernels()["bucket"](starts, sortedValues, np.asarray(breakpoints, dtype=float),
+                                   _top_fractions(breakpoints), min_count, codes)
+        return order, codes
+
+    num = np.repeat(np.diff(starts), np.diff(starts))
+    pos = np.arange(len(order)) - np.repeat(starts[:-1], np.diff(starts))
+    codes = bucket_codes(pos, num, sortedValues, breakpoints)
+    codes[num < min_count] = -1
+    return order, codes
+
+
+def _group_sum_numpy(labels, values, ngroups):
+    '''
+    Kahan sums of every group in row order, the k-th rows of all the groups are added at once
+    '''
+    K = values.shape[1]
+    rows = np.flatnonzero(labels >= 0)
+    rows = rows[np.argsort(labels[rows], kind="stable")]
+    counts = np.bincount(labels[rows], minlength=ngroups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    # groups from the largest, so the groups with a k-th row are a prefix
+    bysize = np.argsort(-counts, kind="stable")
+    negsizes = -counts[bysize]
+
+    sums = np.zeros((ngroups, K))
+    compensation = np.zeros((ngroups, K))
+    nobs = np.zeros((ngroups, K), dtype=np.int64)
+    with np.errstate(invalid="ignore"):
+        for k in range(counts.max(initial=0)):
+            groups = bysize[:np.searchsorted(negsizes, -k, side="left")]
+            val = values[rows[starts[groups] + k]]
+            valid = val == val
+            s, c = sums[groups], compensation[groups]
+            y = val - c
+            t = s + y
+            c2 = t - s - y
+            c2[c2 != c2] = 0.0
+            sums[groups] = np.where(valid, t, s)
+            compensation[groups] = np.where(valid, c2, c)
+            nobs[groups] += valid
+    return sums, nobs, counts
+
+
+def group_sum(labels, values, ngroups):
+    '''
+    labels: int array, group of every row, -1 for rows in no group
+    values: 2-d float array, rows x columns
+    :return: (sums, non-missing values, rows) of every group
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    values = np.ascontiguousarray(values, dtype=float)
+    if _backend == "numba":
+        return _numba_kernels()["group_sum"](labels, values, ngroups)
+    return _group_sum_numpy(labels, values, ngroups)
+
+
+def group_reduce(keys, values, how="sum"):
+    '''
+    groupby(keys, observed=True).sum() or .mean() on the kernels
+    keys: list of pd.Series or arrays, values: pd.DataFrame()
+    :return: pd.DataFrame(), index = the observed keys in sorted order, columns = the columns of values
+    '''
+    codes, uniques = [], []
+    for key in keys:
+        code, unique = pd.factorize(key, sort=True)
+        codes.append(code)
+        uniques.append(unique)
+    labels = np.zeros(len(values), dtype=np.int64)
+    missing = np.zeros(len(values), dtype=bool)
+    ngroups = 1
+    for code, unique in zip(codes, uniques):
+        labels = labels * len(unique) + code
+        missing |= code < 0
+        ngroups *= len(unique)
+    labels[missing] = -1
+
+    sums, nobs, counts = group_sum(labels, values.to_numpy(dtype=float), ngroups)
+    if how == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sums = np.where(nobs > 0, sums / nobs, np.nan)
+    observed = np.flatnonzero(counts > 0)
+
+    names = [getattr(key, "name", None) for key in keys]
+    levelCodes = []
+    rest = observed
+    for unique in reversed(uniques):
+        levelCodes.append(rest % len(unique))
+        rest = rest // len(unique)
+    levelCodes.reverse()
+    if len(keys) == 1:
+        index = pd.Index(uniques[0], name=names[0])[levelCodes[0]]
+    else:
+        index = pd.MultiIndex(levels=[pd.Index(unique) for unique in uniques], codes=levelCodes, names=names)
+    return pd.DataFrame(sums[observed], index=index, columns=values.columns)
@@ -0,0 +1,217 @@
+'''
+stage timers, row counts and peak RSS of the factor and regression pipelines
+
+switched on by the environment variable FFTM_METRICS=1 or enable(), when off a timed function costs one flag check
+
+    FFTM_METRICS=1 FFTM_METRICS_REPORT=metrics.json FFTM_METRICS_TEXTFILE=/var/lib/node_exporter/fftm.prom \
+        python calculateThreeFactors.py
+
+flush() writes the report (json or csv by the extension) and the Prometheus textfile named by the environment
+'''
+import os
+import csv
+import json
+import time
+import threading
+import functools
+import contextlib
+
+_enabled = os.environ.get("FFTM_METRICS", "") not in ("", "0")
+_records = []
+_lock = threading.Lock()
+# the stages being timed, per thread, so the stages of pipeline threads do not nest into each other
+_local = threading.local()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        del _records[:]
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def peak_rss_mb():
+    '''
+    peak resident set size of the process, None where the resource module is missing (Windows)
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class _Record(object):
+    __slots__ = ("stage", "parent", "seconds", "rows", "peak_rss_mb", "rss_growth_mb")
+
+    def __init__(self, stage, parent):
+        self.stage = stage
+        self.parent = parent
+        self.seconds = None
+        self.rows = None
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _NullRecord(object):
+    rows = None
+
+
+_null = _NullRecord()
+
+
+@contextlib.contextmanager
+def _timed_stage(name, rows):
+    stack = _stack()
+    record = _Record(name, stack[-1].stage if stack else None)
+    record.rows = rows
+    stack.append(record)
+    rss = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.peak_rss_mb = peak_rss_mb()
+        if rss is not None:
+            record.rss_growth_mb = record.peak_rss_mb - rss
+        stack.pop()
+        with _lock:
+            _records.append(record)
+
+
+def stage(name, rows=None):
+    '''
+    context manager timing a stage, set .rows on the yielded record when the row count is known at the end
+
+        with stage("read_stocks") as record:
+            stocks = read_panel(...)
+            record.rows = len(stocks)
+    '''
+    if not _enabled:
+        return contextlib.nullcontext(_null)
+    return _timed_stage(name, rows)
+
+
+def timed(name=None, rows=len):
+    '''
+    decorator timing every call of a function as a stage
+    rows: function of the result returning its row count, None for no count
+    '''
+    def decorator(func):
+        stagename = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _timed_stage(stagename, None) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    try:
+                        record.rows = rows(result)
+                    except TypeError:
+                        pass
+            return result
+        return wrapper
+    return decorator
+
+
+def _snapshot():
+    with _lock:
+        return list(_records)
+
+
+def records():
+    return [record.as_dict() for record in _snapshot()]
+
+
+def summary():
+    '''
+    :return: list of dicts, one per stage in order of first appearance: "stage","calls","seconds","rows","peak_rss_mb"
+    '''
+    stages = {}
+    for record in _snapshot():
+        res = stages.setdefault(record.stage, {"stage": record.stage, "calls": 0, "seconds": 0.0, "rows": None,
+                                               "peak_rss_mb": None})
+        res["calls"] += 1
+        res["seconds"] += record.seconds
+        if record.rows is not None:
+            res["rows"] = (res["rows"] or 0) + record.rows
+        if record.peak_rss_mb is not None:
+            res["peak_rss_mb"] = max(res["peak_rss_mb"] or 0, record.peak_rss_mb)
+    return list(stages.values())
+
+
+def write_report(filename):
+    '''
+    .csv: the summary, otherwise json with the summary and every record
+    '''
+    if filename.endswith(".csv"):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, ["stage", "calls", "seconds", "rows", "peak_rss_mb"])
+            writer.writeheader()
+            writer.writerows(summary())
+    else:
+        with open(filename, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": summary(), "records": records()},
+                      f, indent=1)
+
+
+def write_prometheus(filename, prefix="fftm"):
+    '''
+    Prometheus textfile collector format, written through a temporary file so the collector never reads half of it
+    '''
+    lines = []
+    metrics = [("seconds", "stage_seconds", "gauge", "wall time of the stage in the last run"),
+               ("calls", "stage_calls", "gauge", "calls of the stage in the last run"),
+               ("rows", "stage_rows", "gauge", "rows processed by the stage in the last run"),
+               ("peak_rss_mb", "stage_peak_rss_megabytes", "gauge", "peak RSS of the process at the end of the stage")]
+    stages = summary()
+    for key, metric, kind, text in metrics:
+        lines.append("# HELP {}_{} {}".format(prefix, metric, text))
+        lines.append("# TYPE {}_{} {}".format(prefix, metric, kind))
+        for res in stages:
+            if res[key] is not None:
+                lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, metric, res["stage"], res[key]))
+    with open(filename + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(filename + ".tmp", filename)
+
+
+def flush():
+    '''
+    write the report and the textfile named by FFTM_METRICS_REPORT and FFTM_METRICS_TEXTFILE, if enabled
+    '''
+    if not _enabled:
+        return
+    report = os.environ.get("FFTM_METRICS_REPORT")
+    textfile = os.environ.get("FFTM_METRICS_TEXTFILE")
+    if report:
+        write_report(report)
+    if textfile:
+        write_prometheus(textfile)
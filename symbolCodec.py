@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+
+def decode_bytes(values):
+    '''
+    decode the bytes symbols of the database once per distinct symbol instead of once per row
+    :return: pd.Series(), categorical
+    '''
+    values = pd.Series(values).astype("category")
+    categories = [value.decode('utf-8') if isinstance(value, bytes) else value for value in values.cat.categories]
+    return values.cat.rename_categories(categories)
+
+
+class SymbolDateCodec(object):
+    '''
+    dictionary encoding shared by the factor pipeline: int32 symbol ids and int32 trading day ordinals
+    symbols keep their id when new symbols are added, so ids of earlier tables stay valid
+    '''
+
+    def __init__(self, symbols=(), dates=()):
+        self.symbols = pd.Index([], dtype=object)
+        self.dates = pd.DatetimeIndex([])
+        self.add_symbols(symbols)
+        self.add_dates(dates)
+
+    def add_symbols(self, values):
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.categories.to_series()
+        new = pd.Index(values.dropna().unique()).difference(self.symbols)
+        self.symbols = self.symbols.append(pd.Index(sorted(new), dtype=object))
+
+    def add_dates(self, values):
+        values = pd.DatetimeIndex(pd.Series(values).dropna().unique())
+        self.dates = self.dates.union(values)
+
+    def encode_symbols(self, values, add=False):
+        '''
+        :return: np.array of int32, -1 for symbols not in the dictionary
+        '''
+        values = pd.Series(values)
+        if add:
+            self.add_symbols(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            ids = self.symbols.get_indexer(values.cat.categories).astype(np.int32)
+            codes = values.cat.codes.to_numpy()
+            return np.where(codes >= 0, ids[codes], -1).astype(np.int32)
+        return self.symbols.get_indexer(values).astype(np.int32)
+
+    def encode_dates(self, values, add=False):
+        '''
+        :return: np.array of int32, ordinal of the trading day, -1 for dates not in the calendar
+        '''
+        values = pd.DatetimeIndex(values)
+        if add:
+            self.add_dates(values)
+        return self.dates.get_indexer(values).astype(np.int32)
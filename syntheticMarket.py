@@ -0,0 +1,134 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+
+
+def generate_market(nsymbols=500, ndays=250, nfunds=50, startdate="2015-01-01", missing_rate=0.02,
+                    sort_every=1, seed=0):
+    '''
+    a synthetic A-share like market with the data layout of the database and csv dumps
+
+    stock returns follow market, size and value factors with random loadings, market cap follows the returns,
+    PB is persistent and partly negative or missing, fund returns are factor exposures with a market timing term
+
+    nsymbols, ndays, nfunds: size of the panels
+    missing_rate: share of stock days suspended (no row) and of PB/CAP values missing
+    sort_every: PB and CAP data are on every sort_every-th trading day
+    :return: {"stocks": "date","symbol","return","close","total_shares","free_float_shares",
+              "PB": "symbol","date","value", "CAP": "symbol","date","value",
+              "funds": "date","symbol","adjusted_net_asset_value",
+              "index": "date","symbol","close", "factors": index = date, "Rm","SMB","HML"}
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(startdate, periods=ndays)
+    symbols = np.array(["{:06d}.{}".format(i + 1, "SZ" if i % 2 else "SH") for i in range(nsymbols)])
+
+    factors = pd.DataFrame({"Rm": rng.normal(0.0003, 0.013, ndays),
+                            "SMB": rng.normal(0.0002, 0.006, ndays),
+                            "HML": rng.normal(0.0001, 0.005, ndays)}, index=dates)
+    factors.index.name = "date"
+    loadings = np.column_stack([rng.normal(1.0, 0.25, nsymbols), rng.normal(0.0, 0.6, nsymbols),
+                                rng.normal(0.0, 0.6, nsymbols)])
+    returns = factors.to_numpy() @ loadings.T + rng.normal(0, 0.02, (ndays, nsymbols))
+    returns = np.clip(returns, -0.1, 0.1)
+    close = 10 * np.exp(rng.normal(0, 1, nsymbols)) * np.cumprod(1 + returns, axis=0)
+    total_shares = np.exp(rng.normal(20, 1.2, nsymbols))
+    free_float_shares = total_shares * rng.uniform(0.2, 1.0, nsymbols)
+
+    stocks = pd.DataFrame({"date": np.repeat(dates, nsymbols), "symbol": np.tile(symbols, ndays),
+                           "close": close.ravel(), "total_shares": np.tile(total_shares, ndays),
+                           "free_float_shares": np.tile(free_float_shares, ndays)})
+    stocks = stocks[rng.random(len(stocks)) >= missing_rate]
+    stocks = stocks.sort_values(["symbol", "date"], kind="mergesort").reset_index(drop=True)
+    previous = stocks.groupby("symbol")["close"].shift(periods=1)
+    stocks["return"] = (stocks["close"] - previous) / previous
+    stocks = stocks[["date", "symbol", "return", "close", "total_shares", "free_float_shares"]]
+
+    sortdates = dates[::sort_every]
+    ncross = len(sortdates) * nsymbols
+    cap = np.log(close[::sort_every] * total_shares).ravel()
+    pb = np.exp(rng.normal(0.8, 0.7, nsymbols) + np.cumsum(rng.normal(0, 0.05, (len(sortdates), nsymbols)), axis=0))
+    pb = pb.ravel() * np.where(rng.random(ncross) < 0.03, -1, 1)
+    cross = {"symbol": np.tile(symbols, len(sortdates)), "date": np.repeat(sortdates, nsymbols)}
+    CAP = pd.DataFrame(dict(cross, value=np.where(rng.random(ncross) < missing_rate, np.nan, cap)))
+    PB = pd.DataFrame(dict(cross, value=np.where(rng.random(ncross) < missing_rate, np.nan, pb)))
+
+    fundids = np.array(["{:06d}.OF".format(i + 1) for i in range(nfunds)])
+    exposures = np.column_stack([rng.normal(0.9, 0.15, nfunds), rng.normal(0.2, 0.3, nfunds),
+                                 rng.normal(0.0, 0.3, nfunds)])
+    timing = rng.normal(0, 1.0, nfunds)
+    fundreturns = (factors.to_numpy() @ exposures.T + np.outer(factors["Rm"].to_numpy() ** 2, timing)
+                   + rng.normal(0.0001, 0.004, (ndays, nfunds)))
+    nav = np.cumprod(1 + fundreturns, axis=0)
+    funds = pd.DataFrame({"date": np.repeat(dates, nfunds), "symbol": np.tile(fundids, ndays),
+                          "adjusted_net_asset_value": nav.ravel()})
+    funds = funds[rng.random(len(funds)) >= missing_rate / 2]
+    funds = funds.sort_values(["symbol", "date"], kind="mergesort").reset_index(drop=True)
+
+    index = pd.DataFrame({"date": dates, "symbol": "000001.SH",
+                          "close": 3000 * np.cumprod(1 + factors["Rm"].to_numpy())})
+
+    return {"stocks": stocks, "PB": PB, "CAP": CAP, "funds": funds, "index": index, "factors": factors}
+
+
+def write_market(market, dirname, database=True):
+    '''
+    write the synthetic market with the file names used by get_factors and the regression functions,
+    and a SQLite stand-in of the database if database is True
+    :return: {"stocks": filename, "PB": filename, "CAP": filename, "factors": filename, "database": filename}
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    dates = market["stocks"]["date"]
+    period = "{}to{}".format(dates.min().strftime("%Y%m%d"), dates.max().strftime("%Y%m%d"))
+    files = {"stocks": os.path.join(dirname, "stock_data{}.csv".format(period)),
+             "PB": os.path.join(dirname, "PB_data{}.csv".format(period)),
+             "CAP": os.path.join(dirname, "CAP_data{}.csv".format(period)),
+             "factors": os.path.join(dirname, "csmar_factor_free_shares.csv")}
+    market["stocks"].drop(columns=["close"]).to_csv(files["stocks"])
+    market["PB"].to_csv(files["PB"], index=False)
+    market["CAP"].to_csv(files["CAP"], index=False)
+    factors = market["factors"].reset_index()
+    factors["date"] = factors["date"].dt.strftime("%Y/%m/%d")
+    factors.to_csv(files["factors"], index=False)
+
+    if database:
+        from dataFetcher import write_sqlite_database
+
+        files["database"] = os.path.join(dirname, "market.sqlite")
+        stocks = market["stocks"].drop(columns=["return"]).assign(instrument_type="stock")
+        funds = market["funds"].assign(instrument_type="mutualfund")
+        index = market["index"].assign(instrument_type="Index")
+        instruments = pd.concat([
+            pd.DataFrame({"symbol": stocks["symbol"].unique(), "instrument_type": "stock"}),
+            pd.DataFrame({"symbol": funds["symbol"].unique(), "instrument_type": "mutualfund",
+                          "invest_type1": "股票型基金"}),
+            pd.DataFrame({"symbol": ["000001.SH"], "instrument_type": "Index"})], ignore_index=True)
+        write_sqlite_database(files["database"], instruments, pd.concat([stocks, funds, index], ignore_index=True))
+    return files
+
+
+def fund_return_matrix(market):
+    '''
+    :return: pd.DataFrame(), index = date, columns = fund ids, as FamaFrenchTM.get_fund_returns
+    '''
+    funds = market["funds"]
+    nav = funds["adjusted_net_asset_value"]
+    previous = nav.groupby(funds["symbol"]).shift(periods=1)
+    returns = funds.assign(**{"return": (nav - previous) / previous})
+    return returns.pivot(index="date", columns="symbol", values="return")
+
+
+def design_frame(market):
+    '''
+    :return: pd.DataFrame(), index = date, columns = "Rm","Rm2","HML","HML2","SMB","SMB2"
+    '''
+    factors = market["factors"].copy()
+    for name in ["Rm", "HML", "SMB"]:
+        factors[name + "2"] = factors[name] * factors[name]
+    return factors
+
+
+if __name__ == '__main__':
+    files = write_market(generate_market(), "synthetic_{}".format(datetime.date.today().strftime("%Y%m%d")))
+    print(files)
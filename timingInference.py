@@ -0,0 +1,188 @@
+'''
+Newey-West and bootstrap inference of the timing coefficients for every fund
+
+newey_west: HAC standard errors of all the coefficients, batched over funds
+bootstrap: residual bootstrap of the t-statistics of the timing terms under the null that they are 0,
+           as the fund skill tests of Kosowski et al. (2006). the pseudo-inverse H = (X'X)^-1 X' of every fund is
+           computed once, a resample only needs H u* and u* - X H u*, all resamples of a fund in two matrix products
+
+timing_inference runs both on shards of funds in a process pool. the random stream of a shard is
+SeedSequence(seed).spawn(number of shards)[shard], so the p-values depend on seed and chunksize, not on workers
+'''
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_FACTORS = ["Rm", "Rm2", "HML", "HML2", "SMB", "SMB2"]
+DEFAULT_TERMS = ["Rm2", "HML2", "SMB2"]
+
+
+def newey_west_lags(nobs):
+    '''
+    the usual rule floor(4 (T/100)^(2/9))
+    '''
+    return np.floor(4 * (np.asarray(nobs) / 100.0) ** (2.0 / 9.0)).astype(int)
+
+
+def _design(returns, factors, factorNames):
+    dates = returns.index.intersection(factors.index).sort_values()
+    x = factors.loc[dates, factorNames].to_numpy(dtype=float)
+    x = np.column_stack([np.ones(len(x)), x])
+    y = returns.loc[dates].to_numpy(dtype=float)
+    return x, y
+
+
+def _compress(x, y):
+    '''
+    the valid rows of every fund moved to the front, so lags are over the fund's own observations as after dropna
+    :return: X (funds, T, k), Y (funds, T), nobs (funds), zero padded
+    '''
+    mask = ~np.isnan(y) & ~np.isnan(x).any(axis=1)[:, None]
+    nobs = mask.sum(axis=0)
+    # stable sort puts the valid rows first in date order
+    order = np.argsort(~mask, axis=0, kind="stable").T
+    valid = np.arange(len(x))[None, :] < nobs[:, None]
+    X = np.where(valid[:, :, None], np.nan_to_num(x)[order], 0.0)
+    Y = np.where(valid, np.take_along_axis(np.nan_to_num(y).T, order, axis=1), 0.0)
+    return X, Y, nobs
+
+
+def _newey_west(X, Y, nobs, lags=None, correction=True):
+    '''
+    :return: params, bse of every fund of the compressed arrays
+    '''
+    from numpy.linalg import pinv
+
+    k = X.shape[2]
+    XtX = np.einsum("ftk,ftj->fkj", X, X)
+    XtXinv = pinv(XtX)
+    params = (XtXinv @ np.einsum("ftk,ft->fk", X, Y)[:, :, None])[:, :, 0]
+    resid = Y - np.einsum("ftk,fk->ft", X, params)
+    scores = X * resid[:, :, None]
+
+    L = newey_west_lags(nobs) if lags is None else np.full(len(nobs), lags)
+    S = np.einsum("ftk,ftj->fkj", scores, scores)
+    for lag in range(1, L.max(initial=0) + 1):
+        weight = np.where(lag <= L, 1 - lag / (L + 1.0), 0.0)
+        gamma = np.einsum("ftk,ftj->fkj", scores[:, lag:], scores[:, :-lag])
+        S += weight[:, None, None] * (gamma + np.transpose(gamma, (0, 2, 1)))
+    cov = XtXinv @ S @ XtXinv
+    if correction:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov *= (nobs / (nobs - k))[:, None, None]
+    bse = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    return params, bse
+
+
+def newey_west(returns, factors, factorNames=None, lags=None, correction=True, chunksize=256):
+    '''
+    OLS of regress() with Newey-West (HAC) standard errors, the same as statsmodels
+    OLS(y, X).fit(cov_type="HAC", cov_kwds={"maxlags": lags, "use_correction": correction}) on every fund;
+    note that statsmodels defaults to use_correction=False
+    @lags: number of lags, default floor(4 (T/100)^(2/9)) of the fund's own T
+    @correction: small sample correction T / (T - k) of the covariance
+    @chunksize: funds per batch, the batch arrays are funds x dates x coefficients
+    :return: pd.DataFrame(), index = fundid, columns = coefficients, "_se_hac", "_t_hac", "_p_hac"
+    '''
+    from scipy import stats
+
+    if factorNames is None:
+        factorNames = DEFAULT_FACTORS
+    names = ["const"] + list(factorNames)
+    x, y = _design(returns, factors, factorNames)
+    parts = []
+    for start in range(0, y.shape[1], chunksize):
+        X, Y, nobs = _compress(x, y[:, start:start + chunksize])
+        parts.append(_newey_west(X, Y, nobs, lags, correction) + (nobs,))
+    if not parts:
+        return pd.DataFrame(index=pd.Index([], name="fundid"))
+    params, bse, nobs = [np.concatenate(part) for part in zip(*parts)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tvalues = params / bse
+    pvalues = 2 * stats.norm.sf(np.abs(tvalues))
+    res = pd.DataFrame(np.hstack([params, bse, tvalues, pvalues]), index=returns.columns,
+                       columns=names + [n + "_se_hac" for n in names] + [n + "_t_hac" for n in names]
+                       + [n + "_p_hac" for n in names])
+    res.index.name = "fundid"
+    return res[nobs > len(names)]
+
+
+def _bootstrap(x, y, termIdx, nboot, rng):
+    '''
+    :return: (t-statistics, bootstrap p-values) of the terms, funds x terms
+    '''
+    k = x.shape[1]
+    xvalid = ~np.isnan(x).any(axis=1)
+    tvalues = np.full((y.shape[1], len(termIdx)), np.nan)
+    pvalues = np.full((y.shape[1], len(termIdx)), np.nan)
+    for f in range(y.shape[1]):
+        mask = xvalid & ~np.isnan(y[:, f])
+        X, Y = x[mask], y[mask, f]
+        n = len(Y)
+        if n <= k:
+            continue
+        H = np.linalg.pinv(X)
+        d = np.einsum("kn,kn->k", H, H)[termIdx]
+        params = H @ Y
+        resid = Y - X @ params
+        tvalues[f] = params[termIdx] / np.sqrt(resid @ resid / (n - k) * d)
+
+        # y* = X b0 + u* with the terms of b0 set to 0, so b* - b0 = H u* and the residuals u* - X H u*
+        ustar = resid[rng.integers(0, n, size=(nboot, n))]
+        deltas = ustar @ H.T
+        estar = ustar - deltas @ X.T
+        sigma2 = np.einsum("bn,bn->b", estar, estar) / (n - k)
+        tstar = deltas[:, termIdx] / np.sqrt(sigma2[:, None] * d)
+        pvalues[f] = (np.abs(tstar) >= np.abs(tvalues[f])).mean(axis=0)
+    return tvalues, pvalues
+
+
+def _run_shard(x, y, names, terms, lags, nboot, seedseq):
+    termIdx = [names.index(term) for term in terms]
+    X, Y, nobs = _compress(x, y)
+    params, bse = _newey_west(X, Y, nobs, lags)
+    tvalues, pvalues = _bootstrap(x, y, termIdx, nboot, np.random.default_rng(seedseq))
+    return params, bse, nobs, tvalues, pvalues
+
+
+def timing_inference(returns, factors, factorNames=None, terms=None, lags=None, nboot=1000, seed=0, workers=None,
+                     chunksize=64):
+    '''
+    Newey-West standard errors of all the coefficients and bootstrap p-values of the timing terms
+    @returns: pd.DataFrame(), index = date, columns = fund ids
+    @factors: pd.DataFrame(), index = date, columns include factorNames
+    @terms: coefficients tested by the bootstrap, default ["Rm2","HML2","SMB2"]
+    @nboot: resamples per fund
+    @workers: processes, 1 runs in this process
+    :return: pd.DataFrame(), index = fundid, columns = coefficients, "_se_hac", "_t_hac", "_p_hac"
+             and "_t", "_p_boot" of the terms
+    '''
+    from scipy import stats
+
+    if factorNames is None:
+        factorNames = DEFAULT_FACTORS
+    if terms is None:
+        terms = [term for term in DEFAULT_TERMS if term in factorNames]
+    names = ["const"] + list(factorNames)
+    x, y = _design(returns, factors, factorNames)
+    shards = range(0, y.shape[1], chunksize)
+    seeds = np.random.SeedSequence(seed).spawn(len(shards))
+    tasks = [(x, y[:, start:start + chunksize], names, terms, lags, nboot, seeds[i]) for i, start in enumerate(shards)]
+
+    if workers == 1:
+        results = [_run_shard(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_run_shard, *zip(*tasks))) if tasks else []
+    if not results:
+        return pd.DataFrame(index=pd.Index([], name="fundid"))
+    params, bse, nobs, tvalues, pvalues = [np.concatenate(part) for part in zip(*results)]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        thac = params / bse
+    res = pd.DataFrame(np.hstack([params, bse, thac, 2 * stats.norm.sf(np.abs(thac)), tvalues, pvalues]),
+                       index=returns.columns,
+                       columns=names + [n + "_se_hac" for n in names] + [n + "_t_hac" for n in names]
+                       + [n + "_p_hac" for n in names] + [n + "_t" for n in terms] + [n + "_p_boot" for n in terms])
+    res.index.name = "fundid"
+    return res[nobs > len(names)]